@@ -1,4 +1,8 @@
 import random
+import time
+import ChessEngine
+import ChessBitbase
+import ChessCache
 
 pieceScore = {"K": 0, "Q": 9, "R": 5, "B": 3, "N": 3, "p": 1}
 
@@ -82,6 +86,23 @@ piecePositionScores = {"N" : knightScores, "Q": queenScores, "B": bishopScores,
 CHECKMATE = 1000
 STALEMATE = 0
 DEPTH = 4
+QUIESCENCE_DEPTH = 0 #how many captures deep the search keeps going once DEPTH is reached, 0 turns it off
+HASH_SIZE = 16 #megabytes used by the transposition table, 0 turns it off
+HASH_ENTRY_SIZE = 200 #rough number of bytes one entry of the table takes in memory
+USE_BITBASES = True #look up the endgames generated by ChessBitbase.py instead of searching them
+BITBASE_WIN = 500 #score of a won bitbase position, less the plies to mate so the quickest mate is preferred
+BITBASE_UNKNOWN_PLIES = 100 #plies to mate assumed when only the win/draw/loss file was generated
+MAX_BITBASE_PLIES = 255 #plies to mate are stored in a byte
+CACHE_FILE = None #SQLite file of the analysis cache shared by every process (see ChessCache.py), None turns it off
+USE_NNUE = False #evaluate with the network of NNUE_FILE (see ChessNNUE.py) instead of the tables, needs numpy
+NNUE_FILE = "nnue.npz"
+PSEUDO_LEGAL_MOVES = False #search pseudo-legal moves and only check the ones that get made, see getPseudoLegalMoves
+
+#kinds of score stored in the transposition table
+EXACT = 0
+LOWER_BOUND = 1 #the search failed high, the real score is at least this
+UPPER_BOUND = 2 #the search failed low, the real score is at most this
+transpositionTable = {} #zobrist key -> (depth, score, kind of score, moveID of the best move)
 
 '''
 Picks and returns a random move.
@@ -90,40 +111,339 @@ def findRandomMove(validMoves):
     return validMoves[random.randint(0, len(validMoves) - 1)]
 
 '''
-Helper method to make the first recursive call
+Raised inside the search when it runs out of time or is stopped, the search position is restored by searchPosition
 '''
-def findBestMove(gs, validMoves, returnQueue):
-    global nextMove, counter
-    nextMove = None
+class SearchAborted(Exception):
+    pass
+
+'''
+Helper method to make the first recursive call. It runs in its own process, the position comes as
+GameState.toBytes() so only a few hundred bytes are copied to the process however long the game is
+'''
+def findBestMove(position, returnQueue):
+    gs = ChessEngine.GameState()
+    gs.loadBytes(position)
+    validMoves = gs.getValidMoves()
     random.shuffle(validMoves)
+    move, score, nodes = searchCached(gs, validMoves, DEPTH)
+    print(move, score)
+    print(nodes)
+    if CACHE_FILE is not None:
+        ChessCache.openCache(CACHE_FILE).flush() #the process ends with this move, don't leave the result unwritten
+    returnQueue.put(move)
+
+'''
+searchPosition, answered from the analysis cache when the position was already searched to at least depth by
+any process with the same settings (nodes is 0 then). New results are added to the cache, which writes them
+in batches and when the process exits
+'''
+def searchCached(gs, validMoves, depth=DEPTH):
+    cache = ChessCache.openCache(CACHE_FILE) if CACHE_FILE is not None else None
+    if cache is not None:
+        config = ChessCache.configKey((getNetwork() is not None and NNUE_FILE, QUIESCENCE_DEPTH, PSEUDO_LEGAL_MOVES,
+                                       USE_BITBASES))
+        entry = cache.lookup(gs, depth, config)
+        if entry is not None:
+            for move in validMoves:
+                if move.moveID == entry[0]:
+                    return move, entry[1], 0
+    move, score, nodes = searchPosition(gs, validMoves, depth)
+    if cache is not None and move is not None:
+        cache.record(gs, move, score, depth, config)
+    return move, score, nodes
+
+'''
+Searches the position with iterative deepening, from depth 1 up to depth, trying the best moves of the previous
+iteration first. When timeLimit (in seconds) runs out or stopEvent (a threading.Event) is set, the moves of the
+deepest completed iteration are kept. With multiPV above 1 the best multiPV moves all get an exact score.
+infoCallback, if given, is called after every iteration for each of those lines, best first, with
+(depth, score, nodes, seconds, principal variation, line number starting at 1).
+Returns the best move (None if every move gets mated), its score for the side to move and the nodes searched
+'''
+def searchPosition(gs, validMoves, depth=DEPTH, timeLimit=None, stopEvent=None, infoCallback=None, multiPV=1):
+    global nextMove, counter, rootDepth, deadline, stopSearch, probeBitbases
     counter = 0
-    findMoveNegaMaxAlphaBeta(gs, validMoves, DEPTH, -CHECKMATE, CHECKMATE, 1 if gs.whiteToMove else -1)
-    print(counter)
-    returnQueue.put(nextMove)
+    #one capture away from a bitbase endgame at most, otherwise the nodes would scan the board for nothing
+    probeBitbases = USE_BITBASES and sum(square != "--" for row in gs.board for square in row) <= ChessBitbase.MAX_PIECES + 1
+    startTime = time.time()
+    deadline = startTime + timeLimit if timeLimit is not None else None
+    stopSearch = stopEvent
+    plyCount = len(gs.moveLog)
+    network = getNetwork()
+    if network is not None: #kept up to date by makeMove and undoMove until the search is over
+        gs.accumulator = network.newAccumulator(gs)
+    try:
+        rootMoves = orderMoves(gs, validMoves)
+        bestMove = None
+        bestScore = -CHECKMATE
+        for rootDepth in range(1, depth + 1):
+            nextMove = None
+            try:
+                if multiPV > 1:
+                    lines = searchRootMultiPV(gs, rootMoves, rootDepth, multiPV, 1 if gs.whiteToMove else -1)
+                    score = lines[0][0] if lines else -CHECKMATE
+                    nextMove = lines[0][1] if lines else None
+                else:
+                    score = findMoveNegaMaxAlphaBeta(gs, rootMoves, rootDepth, -CHECKMATE, CHECKMATE, 1 if gs.whiteToMove else -1)
+                    lines = [(score, nextMove)] if nextMove is not None else []
+            except SearchAborted:
+                while len(gs.moveLog) > plyCount: #take back the moves of the unfinished line
+                    gs.undoMove()
+                break
+            bestMove = nextMove
+            bestScore = score
+            if infoCallback is not None:
+                for i in range(len(lines)):
+                    infoCallback(rootDepth, lines[i][0], counter, time.time() - startTime,
+                                 getPrincipalVariation(gs, lines[i][1], rootDepth), i + 1)
+            if bestMove is None or (bestScore >= CHECKMATE and multiPV == 1): #mated whatever we play, or found a mate already
+                break
+            if isBitbaseScore(bestScore) and multiPV == 1: #the bitbase already knows the result, deeper won't change it
+                break
+            for lineScore, move in reversed(lines): #the best lines go first in the next iteration, in order
+                rootMoves.remove(move)
+                rootMoves.insert(0, move)
+    finally:
+        gs.accumulator = None
+    return bestMove, bestScore, counter
+
+'''
+The network to evaluate with, or None to use the tables: USE_NNUE is off, numpy is not installed or the
+network file was not made yet
+'''
+def getNetwork():
+    if not USE_NNUE:
+        return None
+    try:
+        import ChessNNUE
+    except ImportError:
+        return None
+    return ChessNNUE.loadNetwork(NNUE_FILE)
+
+'''
+Searches the root for multi-PV: a move only gets in if it beats the worst of the best multiPV lines found so far,
+and the window above that is left open, so the lines that get in have exact scores.
+Returns the lines as (score, move), best first
+'''
+def searchRootMultiPV(gs, rootMoves, depth, multiPV, turnMultiplier):
+    global counter
+    counter += 1
+    lines = []
+    for move in rootMoves:
+        alpha = lines[-1][0] if len(lines) == multiPV else -CHECKMATE
+        gs.makeMove(move)
+        score = -findMoveNegaMaxAlphaBeta(gs, getMoves(gs), depth - 1, -CHECKMATE, -alpha, -turnMultiplier)
+        gs.undoMove()
+        if score > alpha:
+            lines.append((score, move))
+            lines.sort(key=lambda line: line[0], reverse=True) #stable, so on equal scores the earlier move stays ahead
+            del lines[multiPV:]
+    return lines
+
+'''
+The best count moves of the position from a single multi-PV search, as (move, score, principal variation)
+with the best first. Used for analysis and hints
+'''
+def findBestMoves(gs, validMoves, count, depth=DEPTH, timeLimit=None):
+    iterations = {} #depth -> lines of that iteration
+    def collectLine(depth, score, nodes, seconds, pv, lineNumber):
+        iterations.setdefault(depth, []).append((pv[0], score, pv))
+    searchPosition(gs, validMoves, depth, timeLimit, None, collectLine, count)
+    return iterations[max(iterations)] if iterations else []
 
 def findMoveNegaMaxAlphaBeta(gs, validMoves, depth, alpha, beta, turnMultiplier):
     global nextMove, counter
-    counter += 1
+    if probeBitbases and depth != rootDepth:
+        result = ChessBitbase.probe(gs)
+        if result is not None:
+            return bitbaseScore(result)
     if depth == 0:
+        return quiescenceSearch(gs, validMoves, QUIESCENCE_DEPTH, alpha, beta, turnMultiplier)
+    counter += 1
+    if rootDepth > 1 and counter % 64 == 0:
+        if (deadline is not None and time.time() > deadline) or (stopSearch is not None and stopSearch.is_set()):
+            raise SearchAborted()
+    if len(validMoves) == 0 and not PSEUDO_LEGAL_MOVES: #checkmate or stalemate, pseudo-legal moves find out below
         return turnMultiplier * scoreBoard(gs)
+
+    alphaOriginal = alpha
+    hashMove = None
+    entry = transpositionTable.get(gs.zobristKey) if HASH_SIZE > 0 else None
+    if entry is not None:
+        hashMove = entry[3]
+        if entry[0] >= depth and depth != rootDepth: #already searched deep enough
+            if entry[2] == EXACT or (entry[2] == LOWER_BOUND and entry[1] >= beta) or (entry[2] == UPPER_BOUND and entry[1] <= alpha):
+                return entry[1]
     
     maxScore = -CHECKMATE
-    for move in validMoves:
+    bestMove = None
+    legalMoves = 0
+    for move in (validMoves if depth == rootDepth else orderMoves(gs, validMoves, hashMove)): #root moves are already ordered
             gs.makeMove(move)
-            nextMoves = gs.getValidMoves()
+            if PSEUDO_LEGAL_MOVES and gs.lastMoveLeftKingInCheck():
+                gs.undoMove()
+                continue
+            legalMoves += 1
+            nextMoves = getMoves(gs)
             score = -findMoveNegaMaxAlphaBeta(gs, nextMoves, depth - 1, -beta, -alpha, -turnMultiplier)
             if score > maxScore:
                 maxScore = score
-                if depth == DEPTH:
+                bestMove = move
+                if depth == rootDepth:
                     nextMove = move
-                    print(move, score)
             gs.undoMove()
             if maxScore > alpha: #pruning happens
                 alpha = maxScore
             if alpha >= beta:
                 break
+    if legalMoves == 0: #only possible with pseudo-legal moves, getValidMoves would have found the mate or stalemate
+        maxScore = -CHECKMATE if gs.isKingAttacked('w' if gs.whiteToMove else 'b') else STALEMATE
+
+    if HASH_SIZE > 0:
+        if len(transpositionTable) >= HASH_SIZE * 1024 * 1024 // HASH_ENTRY_SIZE: #table is full, start over
+            transpositionTable.clear()
+        kind = UPPER_BOUND if maxScore <= alphaOriginal else LOWER_BOUND if maxScore >= beta else EXACT
+        if kind == UPPER_BOUND or bestMove is None: #every move failed low, so none of them is known to be best
+            transpositionTable[gs.zobristKey] = (depth, maxScore, kind, hashMove)
+        else:
+            transpositionTable[gs.zobristKey] = (depth, maxScore, kind, bestMove.moveID)
+    return maxScore
+
+'''
+The moves of the position the search just moved to: the legal ones, or with PSEUDO_LEGAL_MOVES the pseudo-legal
+ones, which are checked one by one as they get made
+'''
+def getMoves(gs):
+    return gs.getPseudoLegalMoves() if PSEUDO_LEGAL_MOVES else gs.getValidMoves()
+
+'''
+Sets gs.checkmate or gs.stalemate if the side to move has no legal move among the pseudo-legal ones. The first
+move tried is nearly always legal, so this costs about one makeMove and undoMove
+'''
+def findMate(gs, pseudoLegalMoves):
+    for move in pseudoLegalMoves:
+        gs.makeMove(move)
+        illegal = gs.lastMoveLeftKingInCheck()
+        gs.undoMove()
+        if not illegal:
+            return
+    if gs.isKingAttacked('w' if gs.whiteToMove else 'b'):
+        gs.checkmate = True
+    else:
+        gs.stalemate = True
+
+'''
+Turns a bitbase result for the side to move into a score of the search
+'''
+def bitbaseScore(result):
+    outcome, plies = result
+    if outcome == ChessBitbase.DRAW:
+        return STALEMATE
+    if plies == 0: #checkmated
+        return -CHECKMATE
+    score = BITBASE_WIN - (plies if plies is not None else BITBASE_UNKNOWN_PLIES)
+    return score if outcome == ChessBitbase.WIN else -score
+
+'''
+The plies to mate in a bitbase win or loss score, counted from the position at the end of the line it was found
+with. Returns None for any other score, and when the bitbase only knew the win or loss
+'''
+def bitbasePlies(score):
+    plies = BITBASE_WIN - round(abs(score))
+    if plies < 0 or plies > MAX_BITBASE_PLIES or plies == BITBASE_UNKNOWN_PLIES:
+        return None
+    return plies
+
+def isBitbaseScore(score):
+    return BITBASE_WIN - MAX_BITBASE_PLIES <= abs(score) <= BITBASE_WIN
+
+'''
+Follows the best moves stored in the transposition table, starting with firstMove, to get the line the search expects
+'''
+def getPrincipalVariation(gs, firstMove, depth):
+    pv = [firstMove]
+    gs.makeMove(firstMove)
+    while len(pv) < depth:
+        entry = transpositionTable.get(gs.zobristKey)
+        if entry is None or entry[3] is None:
+            break
+        move = None
+        for validMove in gs.getValidMoves():
+            if validMove.moveID == entry[3]:
+                move = validMove
+                break
+        if move is None:
+            break
+        pv.append(move)
+        gs.makeMove(move)
+    for move in pv:
+        gs.undoMove()
+    return pv
+
+'''
+Keeps searching captures past the depth limit so the position is not scored in the middle of an exchange.
+Captures that the static exchange evaluation says lose material are pruned
+'''
+def quiescenceSearch(gs, validMoves, depth, alpha, beta, turnMultiplier):
+    global counter
+    counter += 1
+    if PSEUDO_LEGAL_MOVES:
+        findMate(gs, validMoves) #scoreBoard needs to know, a stalemate must not stand pat
+    maxScore = turnMultiplier * scoreBoard(gs) #the side to move can always stop capturing
+    if depth == 0 or gs.checkmate or gs.stalemate or maxScore >= beta:
+        return maxScore
+    if maxScore > alpha:
+        alpha = maxScore
+
+    captures = []
+    for move in validMoves:
+        if move.isCapture:
+            see = gs.staticExchangeEvaluation(move)
+            if see >= 0:
+                captures.append((see, move))
+    captures.sort(key=lambda capture: capture[0], reverse=True)
+
+    for see, move in captures:
+        gs.makeMove(move)
+        if PSEUDO_LEGAL_MOVES and gs.lastMoveLeftKingInCheck():
+            gs.undoMove()
+            continue
+        nextMoves = getMoves(gs)
+        score = -quiescenceSearch(gs, nextMoves, depth - 1, -beta, -alpha, -turnMultiplier)
+        gs.undoMove()
+        if score > maxScore:
+            maxScore = score
+        if maxScore > alpha:
+            alpha = maxScore
+        if alpha >= beta:
+            break
     return maxScore
 
+'''
+Orders the moves so the best ones get searched first and alpha-beta prunes more. The best move from the
+transposition table goes first, then winning and even captures (best static exchange first), then the quiet
+moves, and captures that lose material are tried last
+'''
+def orderMoves(gs, moves, hashMove=None):
+    firstMoves = []
+    goodCaptures = []
+    quietMoves = []
+    badCaptures = []
+    for move in moves:
+        if move.moveID == hashMove:
+            firstMoves.append(move)
+        elif move.isCapture or move.isPawnPromotion:
+            see = gs.staticExchangeEvaluation(move)
+            if see >= 0:
+                goodCaptures.append((see, move))
+            else:
+                badCaptures.append((see, move))
+        else:
+            quietMoves.append(move)
+    goodCaptures.sort(key=lambda capture: capture[0], reverse=True)
+    badCaptures.sort(key=lambda capture: capture[0], reverse=True)
+    return firstMoves + [move for see, move in goodCaptures] + quietMoves + [move for see, move in badCaptures]
+
 '''
 A positive score from this is good for white, a negative score is good for black
 '''
@@ -135,6 +455,8 @@ def scoreBoard(gs):
             return CHECKMATE #white wins
     elif gs.stalemate:
         return STALEMATE
+    if gs.accumulator is not None:
+        return gs.accumulator.evaluate(gs.whiteToMove)
 
     score = 0
     for row in range(len(gs.board)):
@@ -0,0 +1,239 @@
+"""
+This is the benchmark. It runs a fixed suite of positions (openings, middlegames, endgames and tactical problems)
+through move generation (perft), evaluation and a fixed depth search, and reports nodes, nodes per second, time to
+solution and how many problems were solved. The results can be written as JSON and compared with the results of an
+earlier run, so a change that makes ChessEngine or ChessAI slower or weaker shows up before it is merged.
+
+Example: python ChessBenchmark.py --repeat 3 --output baseline.json
+         (make the change)
+         python ChessBenchmark.py --repeat 3 --baseline baseline.json --tolerance 0.1
+
+The exit status is 1 when a perft count is wrong or something got worse than the baseline by more than the tolerance.
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+import ChessEngine
+import ChessAI
+import ChessPGN
+
+#EPD lines: the position, then operations. "bm" is the best move of a problem, "am" a move to avoid, "D<n>" the
+#number of leaf nodes of perft at depth n, "c0" the category
+SUITE = [
+    'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - D1 20; D2 400; D3 8902; id "start"; c0 "opening";',
+    'r1bqkbnr/pppp1ppp/2n5/1B2p3/4P3/5N2/PPPP1PPP/RNBQK2R b KQkq - id "ruy lopez"; c0 "opening";',
+    'rnbqkb1r/pp2pppp/3p1n2/8/3NP3/8/PPP2PPP/RNBQKB1R w KQkq - id "sicilian"; c0 "opening";',
+    'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - D1 48; D2 2039; D3 97862; id "kiwipete"; c0 "middlegame";',
+    'r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - D1 46; D2 2079; D3 89890; id "italian"; c0 "middlegame";',
+    'r1bq1rk1/pp2bppp/2n1pn2/3p4/2PP4/2N1PN2/PP3PPP/R2QKB1R w KQ - id "queen\'s gambit"; c0 "middlegame";',
+    '8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - D1 14; D2 191; D3 2812; id "rook and pawns"; c0 "endgame";',
+    '8/8/8/4k3/8/8/4P3/4K3 w - - id "king and pawn"; c0 "endgame";',
+    '6k1/5ppp/8/8/8/8/5PPP/3R2K1 w - - bm Rd8+; id "back rank"; c0 "endgame";',
+    '2rr3k/pp3pp1/1nnqbN1p/3pN3/2pP4/2P3Q1/PPB4P/R4RK1 w - - bm Qg6; id "WAC.001"; c0 "tactical";',
+    '8/7p/5k2/5p2/p1p2P2/Pr1pPK2/1P1R3P/8 b - - bm Rxb2; id "WAC.002"; c0 "tactical";',
+    'r1bq2rk/pp3pbp/2p1p1pQ/7P/3P4/2PB1N2/PP3PPR/2KR4 w - - bm Qxh7+; id "WAC.004"; c0 "tactical";',
+    '5k2/6pp/p1qN4/1p1p4/3P4/2PKP2Q/PP3r2/3R4 b - - bm Qc4+; id "WAC.005"; c0 "tactical";',
+    'rnbqkb1r/pppp1ppp/8/4P3/6n1/7P/PPPNPPP1/R1BQKBNR b KQkq - bm Ne3; id "WAC.007"; c0 "tactical";',
+    '3q1rk1/p4pp1/2pb3p/3p4/6Pr/1PNQ4/P1PB1PP1/4RRK1 b - - bm Bh2+; id "WAC.009"; c0 "tactical";',
+    '2br2k1/2q3rn/p2NppQ1/2p1P3/Pp5R/4P3/1P3PPP/3R2K1 w - - bm Rxh7; id "WAC.010"; c0 "tactical";',
+]
+
+SEARCH_DEPTH = 3
+PERFT_DEPTH = 3 #perft goes no deeper than this even if the suite has the count of a deeper one
+EVAL_REPETITIONS = 2000 #evaluations timed per position
+SPEED_RESULTS = ["perftNps", "evalsPerSecond", "searchNps"] #results where a lower number is worse
+
+'''
+Splits an EPD line into the FEN of the position and a dictionary of its operations
+'''
+def parseEPD(line):
+    fields = line.split(None, 4)
+    if len(fields) < 4:
+        raise ValueError("not an EPD line: " + line)
+    operations = {}
+    for operation in fields[4].split(";") if len(fields) > 4 else []:
+        operation = operation.strip()
+        if operation != "":
+            name, _, value = operation.partition(" ")
+            operations[name] = value.strip().strip('"')
+    return " ".join(fields[:4]) + " 0 1", operations
+
+'''
+Reads an EPD file, one position per line, lines starting with # are left out
+'''
+def loadSuite(path):
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip() != "" and not line.startswith("#")]
+
+'''
+Counts the positions at the end of every sequence of depth moves, which tests the move generation
+'''
+def perft(gs, depth):
+    validMoves = gs.getValidMoves()
+    if depth == 1:
+        return len(validMoves)
+    nodes = 0
+    for move in validMoves:
+        gs.makeMove(move)
+        nodes += perft(gs, depth - 1)
+        gs.undoMove()
+    return nodes
+
+'''
+Runs one position of the suite and returns its results
+'''
+def benchmarkPosition(line, searchDepth, perftDepth):
+    fen, operations = parseEPD(line)
+    gs = ChessEngine.GameState()
+    gs.loadFEN(fen)
+    result = {"id": operations.get("id", fen), "category": operations.get("c0", "")}
+
+    perftDepths = [int(name[1:]) for name in operations if name[0] == "D" and name[1:].isdigit() and int(name[1:]) <= perftDepth]
+    if perftDepths:
+        depth = max(perftDepths)
+        startTime = time.perf_counter()
+        nodes = perft(gs, depth)
+        seconds = time.perf_counter() - startTime
+        result["perft"] = {"depth": depth, "nodes": nodes, "expected": int(operations["D%d" % depth]), "seconds": seconds}
+
+    startTime = time.perf_counter()
+    for i in range(EVAL_REPETITIONS):
+        ChessAI.scoreBoard(gs)
+    result["evalSeconds"] = time.perf_counter() - startTime
+
+    validMoves = gs.getValidMoves()
+    goodMoves = [ChessPGN.sanToMove(san, validMoves).moveID for san in operations.get("bm", "").split()]
+    badMoves = [ChessPGN.sanToMove(san, validMoves).moveID for san in operations.get("am", "").split()]
+    solvedAt = [None] #seconds at the end of the first iteration from which the best move stays a good one
+    def checkIteration(depth, score, nodes, seconds, pv, lineNumber):
+        isGood = (not goodMoves or pv[0].moveID in goodMoves) and pv[0].moveID not in badMoves
+        if not isGood:
+            solvedAt[0] = None
+        elif solvedAt[0] is None:
+            solvedAt[0] = seconds
+    ChessAI.transpositionTable.clear() #every position starts the same way whatever ran before it
+    startTime = time.perf_counter()
+    move, score, nodes = ChessAI.searchPosition(gs, validMoves, searchDepth, infoCallback=checkIteration)
+    seconds = time.perf_counter() - startTime
+    result["search"] = {"depth": searchDepth, "nodes": nodes, "seconds": seconds, "score": score,
+                        "move": ChessPGN.moveToSAN(gs, move, validMoves) if move is not None else None}
+    if goodMoves or badMoves:
+        result["search"]["solved"] = move is not None and solvedAt[0] is not None
+        result["search"]["timeToSolution"] = solvedAt[0] if result["search"]["solved"] else None
+    return result
+
+'''
+Runs the suite and returns the results of every position with the totals. With repeat above 1 every position
+is run that many times and the fastest times are kept, which takes out most of the noise of a busy computer
+'''
+def runBenchmark(suite, searchDepth=SEARCH_DEPTH, perftDepth=PERFT_DEPTH, repeat=1, verbose=True):
+    #the bitbases and the analysis cache depend on files on this computer, they would make runs incomparable
+    ChessAI.USE_BITBASES = False
+    ChessAI.CACHE_FILE = None
+    positions = []
+    for line in suite:
+        result = benchmarkPosition(line, searchDepth, perftDepth)
+        for i in range(repeat - 1): #the nodes are the same every time, only the times change
+            again = benchmarkPosition(line, searchDepth, perftDepth)
+            result["evalSeconds"] = min(result["evalSeconds"], again["evalSeconds"])
+            if "perft" in result:
+                result["perft"]["seconds"] = min(result["perft"]["seconds"], again["perft"]["seconds"])
+            if again["search"]["seconds"] < result["search"]["seconds"]:
+                result["search"] = again["search"]
+        positions.append(result)
+        if verbose:
+            search = result["search"]
+            text = "%-16s %-10s search %7d nodes %6.2f s %-7s" % (result["id"], result["category"], search["nodes"],
+                                                                 search["seconds"], search["move"])
+            if "solved" in search:
+                text += " solved" if search["solved"] else " not solved"
+            if "perft" in result:
+                text += "  perft(%d) %d%s" % (result["perft"]["depth"], result["perft"]["nodes"],
+                                              "" if result["perft"]["nodes"] == result["perft"]["expected"] else
+                                              " expected %d" % result["perft"]["expected"])
+            print(text, flush=True)
+
+    perftResults = [result["perft"] for result in positions if "perft" in result]
+    searches = [result["search"] for result in positions]
+    problems = [search for search in searches if "solved" in search]
+    totals = {
+        "perftNodes": sum(perft["nodes"] for perft in perftResults),
+        "perftNps": sum(perft["nodes"] for perft in perftResults) / max(sum(perft["seconds"] for perft in perftResults), 1e-9),
+        "perftErrors": sum(perft["nodes"] != perft["expected"] for perft in perftResults),
+        "evalsPerSecond": len(positions) * EVAL_REPETITIONS / max(sum(result["evalSeconds"] for result in positions), 1e-9),
+        "searchNodes": sum(search["nodes"] for search in searches),
+        "searchNps": sum(search["nodes"] for search in searches) / max(sum(search["seconds"] for search in searches), 1e-9),
+        "solved": sum(search["solved"] for search in problems),
+        "problems": len(problems),
+    }
+    return {"python": platform.python_version(), "searchDepth": searchDepth, "perftDepth": perftDepth,
+            "totals": totals, "positions": positions}
+
+'''
+Compares the results with a baseline run, returns the lines describing what got worse (empty if nothing did)
+and the lines describing what only changed
+'''
+def compareResults(results, baseline, tolerance):
+    regressions = []
+    changes = []
+    totals = results["totals"]
+    baseTotals = baseline["totals"]
+    if totals["perftErrors"] > 0:
+        regressions.append("%d perft counts are wrong" % totals["perftErrors"])
+    sameRun = (results["searchDepth"] == baseline["searchDepth"] and
+               [result["id"] for result in results["positions"]] == [result["id"] for result in baseline["positions"]])
+    if not sameRun:
+        changes.append("the baseline was run on other positions or at another depth, only the speeds are comparable")
+    for name in SPEED_RESULTS:
+        ratio = totals[name] / max(baseTotals[name], 1e-9)
+        line = "%s %.0f -> %.0f (%+.1f%%)" % (name, baseTotals[name], totals[name], (ratio - 1) * 100)
+        (regressions if ratio < 1 - tolerance else changes).append(line)
+    if sameRun:
+        #the search is deterministic, so a different node count means the search itself changed
+        if totals["searchNodes"] != baseTotals["searchNodes"]:
+            ratio = totals["searchNodes"] / max(baseTotals["searchNodes"], 1)
+            line = "searchNodes %d -> %d (%+.1f%%)" % (baseTotals["searchNodes"], totals["searchNodes"], (ratio - 1) * 100)
+            (regressions if ratio > 1 + tolerance else changes).append(line)
+        if totals["solved"] < baseTotals["solved"]:
+            regressions.append("solved %d -> %d" % (baseTotals["solved"], totals["solved"]))
+        elif totals["solved"] > baseTotals["solved"]:
+            changes.append("solved %d -> %d" % (baseTotals["solved"], totals["solved"]))
+    return regressions, changes
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures the speed and the tactical strength of the engine")
+    parser.add_argument("--suite", help="EPD file to run instead of the built in positions")
+    parser.add_argument("--depth", type=int, default=SEARCH_DEPTH, help="search depth for every position")
+    parser.add_argument("--perft-depth", type=int, default=PERFT_DEPTH, help="deepest perft to run")
+    parser.add_argument("--repeat", type=int, default=1, help="run every position this many times and keep the fastest")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="fraction a result may get worse by (default 0.1)")
+    args = parser.parse_args()
+
+    suite = loadSuite(args.suite) if args.suite is not None else SUITE
+    results = runBenchmark(suite, args.depth, args.perft_depth, args.repeat)
+    totals = results["totals"]
+    print("perft: %d nodes, %.0f nodes/s, %d wrong" % (totals["perftNodes"], totals["perftNps"], totals["perftErrors"]))
+    print("eval: %.0f positions/s" % totals["evalsPerSecond"])
+    print("search: %d nodes, %.0f nodes/s, %d of %d problems solved" % (totals["searchNodes"], totals["searchNps"],
+                                                                        totals["solved"], totals["problems"]))
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+
+    regressions = ["%d perft counts are wrong" % totals["perftErrors"]] if totals["perftErrors"] > 0 else []
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions, changes = compareResults(results, json.load(f), args.tolerance)
+        for line in changes:
+            print("changed: " + line)
+    for line in regressions:
+        print("REGRESSION: " + line)
+    sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
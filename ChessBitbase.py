@@ -0,0 +1,284 @@
+"""
+This file is responsible for the endgame bitbases: exact results for king and queen, king and rook, and king and
+pawn against a lone king. They are generated on this computer by retrograde analysis (starting from the checkmates
+and working backwards), so nothing has to be downloaded. Every position takes 2 bits for win/draw/loss, plus one
+byte for the number of plies to mate. The files are memory mapped when the search first needs them.
+
+Generate them with: python ChessBitbase.py (add --wdl-only to skip the distance to mate files)
+"""
+
+import argparse
+import mmap
+import os
+import struct
+import time
+
+BITBASE_DIRECTORY = "bitbases"
+ENDGAMES = ["KQK", "KRK", "KPK"] #KPK needs KQK for the promotions, so it comes after it
+MAX_PIECES = 3 #kings included
+fileHeader = struct.Struct("<4sB3x") #magic, version
+MAGIC = b"CBB1"
+VERSION = 1
+
+#results from the point of view of the side to move, as stored in the 2 bits of a position
+DRAW = 0
+WIN = 1
+LOSS = 2
+ILLEGAL = 3
+
+#a position is indexed by side to move (0 when the side with the extra piece moves), the square of that side's king,
+#the square of the lone king and the square of the piece. Squares are row * 8 + col like on the GameState board, and
+#the side with the piece is always stored as white
+TABLE_SIZE = 2 * 64 * 64 * 64
+
+bitbases = {} #name -> (wdl map, distance to mate map or None), or None if there is no file
+
+def positionIndex(sideToMove, strongKing, weakKing, piece):
+    return sideToMove << 18 | strongKing << 12 | weakKing << 6 | piece
+
+'''
+The squares a king on each square can go to
+'''
+def kingSquares():
+    squares = []
+    for sq in range(64):
+        r, c = divmod(sq, 8)
+        squares.append([(r + dr) * 8 + c + dc for dr in (-1, 0, 1) for dc in (-1, 0, 1)
+                        if (dr, dc) != (0, 0) and 0 <= r + dr < 8 and 0 <= c + dc < 8])
+    return squares
+
+'''
+For each square, the rays a piece on it slides along, nearest square first
+'''
+def slidingRays(directions):
+    rays = []
+    for sq in range(64):
+        r, c = divmod(sq, 8)
+        squareRays = []
+        for dr, dc in directions:
+            ray = []
+            row, col = r + dr, c + dc
+            while 0 <= row < 8 and 0 <= col < 8:
+                ray.append(row * 8 + col)
+                row, col = row + dr, col + dc
+            squareRays.append(ray)
+        rays.append(squareRays)
+    return rays
+
+KING_SQUARES = kingSquares()
+KING_MASKS = [sum(1 << t for t in KING_SQUARES[sq]) for sq in range(64)]
+ROOK_RAYS = slidingRays(((-1, 0), (1, 0), (0, -1), (0, 1)))
+QUEEN_RAYS = slidingRays(((-1, 0), (1, 0), (0, -1), (0, 1), (-1, -1), (-1, 1), (1, -1), (1, 1)))
+
+'''
+Squares the piece attacks, as a bit mask. The strong king blocks the rays, the lone king does not because it
+can't step back along a ray it is attacked on
+'''
+def pieceAttacks(pieceType, piece, strongKing):
+    if pieceType == 'p':
+        r, c = divmod(piece, 8)
+        return sum(1 << ((r - 1) * 8 + c + dc) for dc in (-1, 1) if r > 0 and 0 <= c + dc < 8)
+    mask = 0
+    for ray in (QUEEN_RAYS if pieceType == 'Q' else ROOK_RAYS)[piece]:
+        for sq in ray:
+            mask |= 1 << sq
+            if sq == strongKing:
+                break
+    return mask
+
+'''
+Where the piece can move (or came from, the moves of queens and rooks go both ways) with the kings in the way.
+Pawns only go up the board, a promotion is left out since it leads to another endgame
+'''
+def pieceMoves(pieceType, piece, strongKing, weakKing, backwards=False):
+    if pieceType == 'p':
+        step = 8 if backwards else -8
+        moves = []
+        target = piece + step
+        if 8 <= target < 56 and target != strongKing and target != weakKing:
+            moves.append(target)
+            doubleTarget = target + step
+            if (piece // 8 == (4 if backwards else 6)) and doubleTarget != strongKing and doubleTarget != weakKing:
+                moves.append(doubleTarget)
+        return moves
+    moves = []
+    for ray in (QUEEN_RAYS if pieceType == 'Q' else ROOK_RAYS)[piece]:
+        for sq in ray:
+            if sq == strongKing or sq == weakKing:
+                break
+            moves.append(sq)
+    return moves
+
+'''
+Builds the table of an endgame by retrograde analysis. Returns (results, plies to mate) as two bytearrays of
+TABLE_SIZE entries. promotionTable is the (results, plies to mate) of KQK, needed for KPK
+'''
+def generate(name, promotionTable=None):
+    pieceType = 'p' if name[1] == 'P' else name[1]
+    results = bytearray([ILLEGAL]) * TABLE_SIZE
+    plies = bytearray(TABLE_SIZE)
+    done = bytearray(TABLE_SIZE)
+    movesLeft = bytearray(TABLE_SIZE) #moves of the lone king that are not known to lose yet
+    buckets = [[] for i in range(256)] #positions that are won or lost, by plies to mate
+
+    for strongKing in range(64):
+        for weakKing in range(64):
+            if weakKing == strongKing or KING_MASKS[strongKing] >> weakKing & 1:
+                continue
+            for piece in range(64):
+                if piece == strongKing or piece == weakKing or (pieceType == 'p' and not 8 <= piece < 56):
+                    continue
+                attacked = KING_MASKS[strongKing] | pieceAttacks(pieceType, piece, strongKing)
+                inCheck = attacked >> weakKing & 1
+
+                #lone king to move
+                index = positionIndex(1, strongKing, weakKing, piece)
+                results[index] = DRAW
+                count = 0
+                for sq in KING_SQUARES[weakKing]:
+                    if sq == piece:
+                        count += not KING_MASKS[strongKing] >> piece & 1 #takes the piece if it is not defended
+                    elif not attacked >> sq & 1:
+                        count += 1
+                movesLeft[index] = count
+                if count == 0:
+                    if inCheck:
+                        buckets[0].append(index) #checkmate
+                    else:
+                        done[index] = 1 #stalemate
+
+                #strong side to move, the lone king can't be in check then
+                if not inCheck:
+                    index = positionIndex(0, strongKing, weakKing, piece)
+                    results[index] = DRAW
+                    if pieceType == 'p' and piece < 16 and piece - 8 != strongKing and piece - 8 != weakKing:
+                        queenIndex = positionIndex(1, strongKing, weakKing, piece - 8)
+                        if promotionTable[0][queenIndex] == LOSS:
+                            buckets[promotionTable[1][queenIndex] + 1].append(index)
+
+    #go through the won and lost positions in order of plies to mate, so every position gets its shortest win
+    #and its longest loss
+    for ply in range(256):
+        for index in buckets[ply]:
+            if done[index]:
+                continue
+            done[index] = 1
+            plies[index] = ply
+            sideToMove = index >> 18
+            strongKing = index >> 12 & 63
+            weakKing = index >> 6 & 63
+            piece = index & 63
+            if sideToMove == 1: #the lone king is lost, every move leading here wins
+                results[index] = LOSS
+                if ply == 255:
+                    continue
+                for sq in KING_SQUARES[strongKing]:
+                    if sq != weakKing and sq != piece and not KING_MASKS[sq] >> weakKing & 1:
+                        previous = positionIndex(0, sq, weakKing, piece)
+                        if results[previous] != ILLEGAL and not done[previous]:
+                            buckets[ply + 1].append(previous)
+                for sq in pieceMoves(pieceType, piece, strongKing, weakKing, backwards=True):
+                    previous = positionIndex(0, strongKing, weakKing, sq)
+                    if results[previous] != ILLEGAL and not done[previous]:
+                        buckets[ply + 1].append(previous)
+            else: #the strong side wins, the lone king is lost once all of its moves lead to wins
+                results[index] = WIN
+                if ply == 255:
+                    continue
+                for sq in KING_SQUARES[weakKing]:
+                    if sq != piece and sq != strongKing and not KING_MASKS[strongKing] >> sq & 1:
+                        previous = positionIndex(1, strongKing, sq, piece)
+                        if not done[previous]:
+                            movesLeft[previous] -= 1
+                            if movesLeft[previous] == 0:
+                                buckets[ply + 1].append(previous)
+        buckets[ply] = None
+    return results, plies
+
+'''
+Writes the results packed 4 positions to a byte, and the plies to mate if they are given
+'''
+def save(name, results, plies=None):
+    os.makedirs(BITBASE_DIRECTORY, exist_ok=True)
+    packed = bytearray(TABLE_SIZE // 4)
+    for i in range(TABLE_SIZE):
+        packed[i >> 2] |= results[i] << ((i & 3) * 2)
+    with open(os.path.join(BITBASE_DIRECTORY, name + ".wdl"), "wb") as f:
+        f.write(fileHeader.pack(MAGIC, VERSION) + packed)
+    if plies is not None:
+        with open(os.path.join(BITBASE_DIRECTORY, name + ".dtm"), "wb") as f:
+            f.write(fileHeader.pack(MAGIC, VERSION) + plies)
+
+'''
+Memory maps the files of an endgame, or returns None if they are missing or not bitbase files
+'''
+def loadBitbase(name):
+    if name in bitbases:
+        return bitbases[name]
+    maps = []
+    for extension, size in ((".wdl", TABLE_SIZE // 4), (".dtm", TABLE_SIZE)):
+        try:
+            with open(os.path.join(BITBASE_DIRECTORY, name + extension), "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) #the map stays valid once the file is closed
+        except (OSError, ValueError):
+            data = None
+        if data is not None and (len(data) != fileHeader.size + size or fileHeader.unpack_from(data) != (MAGIC, VERSION)):
+            data = None
+        maps.append(data)
+    bitbases[name] = (maps[0], maps[1]) if maps[0] is not None else None
+    return bitbases[name]
+
+'''
+Looks the position up. Returns None if it is not one of the endgames or its bitbase is missing, otherwise
+(WIN, DRAW or LOSS for the side to move, plies to mate or None if the distance to mate file is missing)
+'''
+def probe(gs):
+    pieces = []
+    for r in range(8):
+        for c in range(8):
+            if gs.board[r][c] != "--":
+                pieces.append((gs.board[r][c], r * 8 + c))
+                if len(pieces) > MAX_PIECES:
+                    return None
+    if len(pieces) != MAX_PIECES:
+        return None
+    extra = [piece for piece in pieces if piece[0][1] != 'K']
+    strongColor, pieceType = extra[0][0][0], extra[0][0][1]
+    table = loadBitbase("K" + pieceType.upper() + "K")
+    if table is None:
+        return None
+    flip = 0 if strongColor == 'w' else 56 #mirrors the rows so the side with the piece plays up the board as white
+    strongKing = weakKing = None
+    for piece, sq in pieces:
+        if piece[1] == 'K':
+            if piece[0] == strongColor:
+                strongKing = sq ^ flip
+            else:
+                weakKing = sq ^ flip
+    index = positionIndex(0 if gs.whiteToMove == (strongColor == 'w') else 1, strongKing, weakKing, extra[0][1] ^ flip)
+    result = table[0][fileHeader.size + (index >> 2)] >> ((index & 3) * 2) & 3
+    if result == ILLEGAL:
+        return None
+    return result, table[1][fileHeader.size + index] if table[1] is not None and result != DRAW else None
+
+def main():
+    parser = argparse.ArgumentParser(description="Generates the endgame bitbases by retrograde analysis")
+    parser.add_argument("endgames", nargs="*", default=ENDGAMES, help="any of " + ", ".join(ENDGAMES))
+    parser.add_argument("--wdl-only", action="store_true", help="don't write the distance to mate files")
+    args = parser.parse_args()
+
+    tables = {}
+    for name in ENDGAMES:
+        if name not in args.endgames and not (name == "KQK" and "KPK" in args.endgames):
+            continue
+        startTime = time.time()
+        tables[name] = generate(name, tables.get("KQK"))
+        results, plies = tables[name]
+        if name in args.endgames:
+            save(name, results, None if args.wdl_only else plies)
+        counts = [results[i * 2**18:(i + 1) * 2**18].count(value) for i in range(2) for value in (WIN, DRAW, LOSS)]
+        print("%s: %d wins %d draws %d losses with the piece to move, %d wins %d draws %d losses without, "
+              "longest mate %d plies, %.1f s" % (name, *counts, max(plies), time.time() - startTime), flush=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+This file is responsible for the analysis cache: the best move, score and depth of every position the engine has
+searched, kept in an SQLite file so it outlives the process that did the search. The AI processes of the game and
+the workers of the server all share the same file. SQLite's write-ahead log lets any number of processes read while
+one of them writes, and results are written in batches so the search doesn't wait for the disk after every move.
+Positions are found by their Zobrist key, which is the same in every process and every run, mixed with a
+fingerprint of the engine settings that change the results so an engine set up differently doesn't reuse them.
+
+Show what is in the cache with: python ChessCache.py analysis.db
+"""
+
+import argparse
+import hashlib
+import multiprocessing.util
+import sqlite3
+import time
+
+BATCH_SIZE = 32 #results kept in memory before they are written
+BATCH_SECONDS = 5 #results are also written once the oldest waiting one is this old
+BUSY_TIMEOUT = 10 #seconds to wait for another process that is writing
+SCHEMA_VERSION = 2
+
+caches = {} #file name -> AnalysisCache opened by this process
+
+'''
+SQLite integers are signed 64 bit, the Zobrist keys are unsigned
+'''
+def toSigned(key):
+    return key - (1 << 64) if key >= 1 << 63 else key
+
+'''
+64 bit fingerprint of the settings, the same in every process and every run (hash() of a string isn't)
+'''
+def configKey(settings):
+    return int.from_bytes(hashlib.blake2b(repr(settings).encode(), digest_size=8).digest(), "little")
+
+class AnalysisCache():
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None) #transactions are started by hand
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL") #a crash can lose the last batch but never corrupts the file
+        self.connection.execute("BEGIN IMMEDIATE") #other processes may be opening the same file right now
+        try:
+            if self.connection.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+                self.connection.execute("DROP TABLE IF EXISTS analysis")
+                self.connection.execute("PRAGMA user_version=%d" % SCHEMA_VERSION)
+            self.connection.execute("CREATE TABLE IF NOT EXISTS analysis (key INTEGER PRIMARY KEY, "
+                                    "moveID INTEGER NOT NULL, score REAL NOT NULL, depth INTEGER NOT NULL) WITHOUT ROWID")
+            self.connection.execute("COMMIT")
+        except sqlite3.Error:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.pending = {} #signed key -> (moveID, score, depth) not written yet
+        self.pendingSince = None
+
+    '''
+    Returns (moveID, score, depth) of the position if it was searched to at least depth, otherwise None.
+    Results that are still waiting to be written are found too. config is the configKey of the engine settings
+    '''
+    def lookup(self, gs, depth, config=0):
+        key = toSigned(gs.zobristKey ^ config)
+        entry = self.pending.get(key)
+        if entry is None:
+            entry = self.connection.execute("SELECT moveID, score, depth FROM analysis WHERE key = ?", (key,)).fetchone()
+        if entry is None or entry[2] < depth:
+            return None
+        return entry
+
+    '''
+    Keeps the result of a search of the position, a shallower result never replaces a deeper one
+    '''
+    def record(self, gs, move, score, depth, config=0):
+        key = toSigned(gs.zobristKey ^ config)
+        entry = self.pending.get(key)
+        if entry is None or entry[2] <= depth:
+            self.pending[key] = (move.moveID, score, depth)
+        if self.pendingSince is None:
+            self.pendingSince = time.time()
+        if len(self.pending) >= BATCH_SIZE or time.time() - self.pendingSince >= BATCH_SECONDS:
+            self.flush()
+
+    '''
+    Writes the waiting results in one transaction
+    '''
+    def flush(self):
+        if not self.pending:
+            return
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            self.connection.executemany("INSERT INTO analysis VALUES (?, ?, ?, ?) ON CONFLICT(key) DO UPDATE SET "
+                                        "moveID = excluded.moveID, score = excluded.score, depth = excluded.depth "
+                                        "WHERE excluded.depth >= analysis.depth",
+                                        [(key,) + entry for key, entry in self.pending.items()])
+            self.connection.execute("COMMIT")
+        except sqlite3.Error:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.pending.clear()
+        self.pendingSince = None
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+        if caches.get(self.path) is self:
+            del caches[self.path]
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM analysis").fetchone()[0] + len(self.pending)
+
+'''
+The cache of the file for this process, opened the first time it is asked for. The caches are closed, and their
+waiting results written, when the process exits, pool workers included
+'''
+def openCache(path):
+    if path not in caches:
+        if not caches:
+            multiprocessing.util.Finalize(None, closeCaches, exitpriority=10)
+        caches[path] = AnalysisCache(path)
+    return caches[path]
+
+def closeCaches():
+    for cache in list(caches.values()):
+        cache.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Shows what is in an analysis cache")
+    parser.add_argument("file", help="the cache file, e.g. analysis.db")
+    args = parser.parse_args()
+    cache = AnalysisCache(args.file)
+    print("%d positions" % len(cache))
+    for depth, count in cache.connection.execute("SELECT depth, COUNT(*) FROM analysis GROUP BY depth ORDER BY depth"):
+        print("depth %d: %d" % (depth, count))
+    cache.close()
+
+if __name__ == "__main__":
+    main()
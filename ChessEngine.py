@@ -4,6 +4,9 @@ also be responsible for determining the valid moves at the current state.
 It will also keep a move log.
 """
 
+import random
+import struct
+
 class GameState():
     def __init__(self):
         #Board is an 8x8 2d list, each element of the list has 2 characters.
@@ -37,6 +40,12 @@ class GameState():
         self.currentCastlingRight = CastleRights(True, True, True, True)
         self.castleRightsLog = [CastleRights(self.currentCastlingRight.wks, self.currentCastlingRight.bks,
                                 self.currentCastlingRight.wqs, self.currentCastlingRight.bqs)]
+        self.startHalfmoveClock = 0 #clocks of the starting position, the moves in the log are counted on top of them
+        self.startFullmoveNumber = 1
+        self.startFEN = None #FEN given to loadFEN, None when the game started from the usual starting position
+        self.zobristKey = self.computeZobristKey() #hash of the position, kept up to date by makeMove and undoMove
+        self.zobristLog = []
+        self.accumulator = None #a ChessNNUE.Accumulator kept up to date by makeMove and undoMove while the AI uses it
 
     '''
     Takes a Move as a parameter and executes it
@@ -82,6 +91,30 @@ class GameState():
         self.castleRightsLog.append(CastleRights(self.currentCastlingRight.wks, self.currentCastlingRight.bks, self.currentCastlingRight.wqs,
                                                 self.currentCastlingRight.bqs))
 
+        #update the hash with everything that changed
+        key = self.zobristKey ^ zobristBlackToMove
+        key ^= zobristPieces[move.pieceMoved][move.startRow * 8 + move.startCol]
+        key ^= zobristPieces[self.board[move.endRow][move.endCol]][move.endRow * 8 + move.endCol]
+        if move.isEnpassantMove:
+            key ^= zobristPieces[move.pieceCaptured][move.startRow * 8 + move.endCol]
+        elif move.pieceCaptured != "--":
+            key ^= zobristPieces[move.pieceCaptured][move.endRow * 8 + move.endCol]
+        if move.isCastleMove:
+            rook = move.pieceMoved[0] + 'R'
+            if move.endCol - move.startCol == 2:
+                key ^= zobristPieces[rook][move.endRow * 8 + move.endCol + 1] ^ zobristPieces[rook][move.endRow * 8 + move.endCol - 1]
+            else:
+                key ^= zobristPieces[rook][move.endRow * 8 + move.endCol - 2] ^ zobristPieces[rook][move.endRow * 8 + move.endCol + 1]
+        key ^= zobristCastling[self.castleRightsLog[-2].getIndex()] ^ zobristCastling[self.castleRightsLog[-1].getIndex()]
+        if self.enpassantPossibleLog[-2] != ():
+            key ^= zobristEnpassant[self.enpassantPossibleLog[-2][1]]
+        if self.enpassantPossible != ():
+            key ^= zobristEnpassant[self.enpassantPossible[1]]
+        self.zobristLog.append(self.zobristKey)
+        self.zobristKey = key
+        if self.accumulator is not None:
+            self.accumulator.makeMove(move)
+
 
     '''
     Undo the last move made
@@ -120,6 +153,9 @@ class GameState():
                     self.board[move.endRow][move.endCol - 2] = self.board[move.endRow][move.endCol + 1]
                     self.board[move.endRow][move.endCol + 1] = "--"
 
+            self.zobristKey = self.zobristLog.pop()
+            if self.accumulator is not None:
+                self.accumulator.undoMove()
             self.checkmate = False
             self.stalemate = False
 
@@ -160,6 +196,175 @@ class GameState():
                 elif move.endCol == 7:
                     self.currentCastlingRight.bks = False
 
+    '''
+    Set up the position described by a FEN string, e.g.
+    "rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq e3 0 1". The move log is cleared
+    '''
+    def loadFEN(self, fen):
+        fields = fen.split()
+        self.board = []
+        for rank in fields[0].split('/'):
+            row = []
+            for char in rank:
+                if char.isdigit():
+                    row.extend(["--"] * int(char))
+                else:
+                    color = 'w' if char.isupper() else 'b'
+                    type = char.upper() if char.upper() != 'P' else 'p'
+                    row.append(color + type)
+                    if type == 'K':
+                        if color == 'w':
+                            self.whiteKingLocation = (len(self.board), len(row) - 1)
+                        else:
+                            self.blackKingLocation = (len(self.board), len(row) - 1)
+            self.board.append(row)
+        if len(self.board) != 8 or any(len(row) != 8 for row in self.board):
+            raise ValueError("invalid FEN board: " + fields[0])
+
+        self.whiteToMove = len(fields) < 2 or fields[1] == 'w'
+        castling = fields[2] if len(fields) > 2 else '-'
+        self.currentCastlingRight = CastleRights('K' in castling, 'k' in castling, 'Q' in castling, 'q' in castling)
+        self.castleRightsLog = [CastleRights(self.currentCastlingRight.wks, self.currentCastlingRight.bks,
+                                self.currentCastlingRight.wqs, self.currentCastlingRight.bqs)]
+        if len(fields) > 3 and fields[3] != '-':
+            self.enpassantPossible = (Move.ranksToRows[fields[3][1]], Move.filesToCols[fields[3][0]])
+        else:
+            self.enpassantPossible = ()
+        self.enpassantPossibleLog = [self.enpassantPossible]
+        self.startHalfmoveClock = int(fields[4]) if len(fields) > 4 else 0
+        self.startFullmoveNumber = int(fields[5]) if len(fields) > 5 else 1
+        self.startFEN = " ".join(fields)
+        self.zobristKey = self.computeZobristKey()
+        self.zobristLog = []
+        self.moveLog = []
+        self.inCheck = False
+        self.pins = []
+        self.checks = []
+        self.checkmate = False
+        self.stalemate = False
+        if self.accumulator is not None:
+            self.accumulator.refresh(self)
+
+    '''
+    Returns the position as a short string of bytes. The board (4 bits per square), side to move, castling
+    rights, en passant square, clocks and history length always take the same 39 bytes. They are followed by the
+    Zobrist keys of the positions since the last capture or pawn move (at most REPETITION_HISTORY of them), which
+    is all the history needed to spot repetitions. Unlike a pickled GameState the size doesn't grow with the length
+    of the game, so this is what gets sent to other processes
+    '''
+    def toBytes(self):
+        board = bytearray(32)
+        for r in range(8):
+            for c in range(0, 8, 2):
+                board[r * 4 + c // 2] = pieceCodes[self.board[r][c]] | pieceCodes[self.board[r][c + 1]] << 4
+        flags = (0 if self.whiteToMove else 1) | self.currentCastlingRight.getIndex() << 1
+        enpassant = self.enpassantPossible[0] * 8 + self.enpassantPossible[1] + 1 if self.enpassantPossible != () else 0
+        halfmoveClock = self.getHalfmoveClock()
+        history = self.zobristLog[len(self.zobristLog) - min(halfmoveClock, REPETITION_HISTORY, len(self.zobristLog)):]
+        return positionFormat.pack(bytes(board), flags, enpassant, halfmoveClock, self.getFullmoveNumber(), len(history)) + \
+               struct.pack("<%dQ" % len(history), *history)
+
+    '''
+    Sets up the position written by toBytes. The move log is cleared, the Zobrist keys of the earlier positions
+    are kept in zobristLog
+    '''
+    def loadBytes(self, data):
+        if len(data) < positionFormat.size:
+            raise ValueError("position is too short")
+        board, flags, enpassant, halfmoveClock, fullmoveNumber, historyLength = positionFormat.unpack_from(data)
+        if len(data) != positionFormat.size + historyLength * 8:
+            raise ValueError("position has the wrong length")
+        self.board = []
+        for r in range(8):
+            row = []
+            for c in range(8):
+                piece = codePieces[board[r * 4 + c // 2] >> (c % 2 * 4) & 15]
+                row.append(piece)
+                if piece == "wK":
+                    self.whiteKingLocation = (r, c)
+                elif piece == "bK":
+                    self.blackKingLocation = (r, c)
+            self.board.append(row)
+
+        self.whiteToMove = not flags & 1
+        self.currentCastlingRight = CastleRights(bool(flags & 2), bool(flags & 4), bool(flags & 8), bool(flags & 16))
+        self.castleRightsLog = [CastleRights(self.currentCastlingRight.wks, self.currentCastlingRight.bks,
+                                self.currentCastlingRight.wqs, self.currentCastlingRight.bqs)]
+        self.enpassantPossible = ((enpassant - 1) // 8, (enpassant - 1) % 8) if enpassant != 0 else ()
+        self.enpassantPossibleLog = [self.enpassantPossible]
+        self.startHalfmoveClock = halfmoveClock
+        self.startFullmoveNumber = fullmoveNumber
+        self.zobristKey = self.computeZobristKey()
+        self.zobristLog = list(struct.unpack_from("<%dQ" % historyLength, data, positionFormat.size))
+        self.moveLog = []
+        self.inCheck = False
+        self.pins = []
+        self.checks = []
+        self.checkmate = False
+        self.stalemate = False
+        self.startFEN = self.getFEN()
+        if self.accumulator is not None:
+            self.accumulator.refresh(self)
+
+    '''
+    Returns the FEN string of the current position
+    '''
+    def getFEN(self):
+        ranks = []
+        for row in self.board:
+            rank = ""
+            empty = 0
+            for square in row:
+                if square == "--":
+                    empty += 1
+                    continue
+                if empty > 0:
+                    rank += str(empty)
+                    empty = 0
+                rank += square[1].upper() if square[0] == 'w' else square[1].lower()
+            if empty > 0:
+                rank += str(empty)
+            ranks.append(rank)
+
+        castling = ("K" if self.currentCastlingRight.wks else "") + ("Q" if self.currentCastlingRight.wqs else "") + \
+                   ("k" if self.currentCastlingRight.bks else "") + ("q" if self.currentCastlingRight.bqs else "")
+        enpassant = Move.colsToFiles[self.enpassantPossible[1]] + Move.rowsToRanks[self.enpassantPossible[0]] if self.enpassantPossible != () else "-"
+
+        return " ".join(("/".join(ranks), 'w' if self.whiteToMove else 'b', castling if castling != "" else "-",
+                         enpassant, str(self.getHalfmoveClock()), str(self.getFullmoveNumber())))
+
+    '''
+    Number of moves since the last capture or pawn move
+    '''
+    def getHalfmoveClock(self):
+        halfmoveClock = 0
+        for move in reversed(self.moveLog):
+            if move.pieceMoved[1] == 'p' or move.isCapture:
+                return halfmoveClock
+            halfmoveClock += 1
+        return halfmoveClock + self.startHalfmoveClock
+
+    '''
+    Starts at 1 and goes up after every black move
+    '''
+    def getFullmoveNumber(self):
+        return self.startFullmoveNumber + sum(1 for move in self.moveLog if move.pieceMoved[0] == 'b')
+
+    '''
+    Computes the Zobrist hash of the position from scratch: one random number for every piece on every square,
+    xored together with the numbers for the side to move, the castling rights and the en passant file
+    '''
+    def computeZobristKey(self):
+        key = 0 if self.whiteToMove else zobristBlackToMove
+        for r in range(8):
+            for c in range(8):
+                if self.board[r][c] != "--":
+                    key ^= zobristPieces[self.board[r][c]][r * 8 + c]
+        key ^= zobristCastling[self.currentCastlingRight.getIndex()]
+        if self.enpassantPossible != ():
+            key ^= zobristEnpassant[self.enpassantPossible[1]]
+        return key
+
     '''
     All moves considering checks
     '''
@@ -215,6 +420,60 @@ class GameState():
 
         return moves
 
+    '''
+    Pseudo-legal moves: the moves of getValidMoves plus the ones that leave the king attacked, generated without
+    looking for pins and checks. A search only makes some of the moves it generates, so it can make a move and
+    then take it back if lastMoveLeftKingInCheck() says it was illegal. Checkmate and stalemate are not detected
+    '''
+    def getPseudoLegalMoves(self):
+        self.pins = [] #nothing counts as pinned, the piece move functions then skip the pin checks
+        moves = []
+        allyColor = 'w' if self.whiteToMove else 'b'
+        for r in range(8):
+            for c in range(8):
+                if self.board[r][c][0] == allyColor:
+                    if self.board[r][c][1] == 'K':
+                        self.getPseudoLegalKingMoves(r, c, moves)
+                    else:
+                        self.moveFunctions[self.board[r][c][1]](r, c, moves)
+        return moves
+
+    '''
+    King moves to any square that doesn't hold an ally piece, and the castle moves that don't start from or pass
+    through an attacked square (whether the king lands on an attacked square is left to lastMoveLeftKingInCheck)
+    '''
+    def getPseudoLegalKingMoves(self, r, c, moves):
+        allyColor = 'w' if self.whiteToMove else 'b'
+        enemyColor = 'b' if self.whiteToMove else 'w'
+        for dr, dc in ((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)):
+            endRow = r + dr
+            endCol = c + dc
+            if 0 <= endRow < 8 and 0 <= endCol < 8 and self.board[endRow][endCol][0] != allyColor:
+                moves.append(Move((r, c), (endRow, endCol), self.board))
+
+        kingside = self.currentCastlingRight.wks if self.whiteToMove else self.currentCastlingRight.bks
+        queenside = self.currentCastlingRight.wqs if self.whiteToMove else self.currentCastlingRight.bqs
+        if (kingside or queenside) and self.getLeastValuableAttacker(r, c, enemyColor) is None:
+            if kingside and self.board[r][c + 1] == "--" and self.board[r][c + 2] == "--" and \
+                    self.getLeastValuableAttacker(r, c + 1, enemyColor) is None:
+                moves.append(Move((r, c), (r, c + 2), self.board, castle=True))
+            if queenside and self.board[r][c - 1] == "--" and self.board[r][c - 2] == "--" and self.board[r][c - 3] == "--" and \
+                    self.getLeastValuableAttacker(r, c - 1, enemyColor) is None:
+                moves.append(Move((r, c), (r, c - 2), self.board, castle=True))
+
+    '''
+    Returns if the king of the given color is attacked by a piece of the other color
+    '''
+    def isKingAttacked(self, color):
+        kingRow, kingCol = self.whiteKingLocation if color == 'w' else self.blackKingLocation
+        return self.getLeastValuableAttacker(kingRow, kingCol, 'b' if color == 'w' else 'w') is not None
+
+    '''
+    Returns if the last move left the king of the side that made it attacked, which makes a pseudo-legal move illegal
+    '''
+    def lastMoveLeftKingInCheck(self):
+        return self.isKingAttacked('b' if self.whiteToMove else 'w')
+
     '''
     All moves without considering checks
     '''
@@ -577,8 +836,114 @@ class GameState():
                         checks.append((endRow, endCol, m[0], m[1]))
         return inCheck, pins, checks
 
+    '''
+    Find the least valuable piece of the given color attacking the square r, c. Squares in removed are treated as
+    empty, so pieces lined up behind an attacker that already captured (x-rays) are found on the next call.
+    Returns (row, col, piece type) or None if the square is not attacked
+    '''
+    def getLeastValuableAttacker(self, r, c, color, removed=()):
+        #pawns attack diagonally forward, so look one row behind the square from the attacker's point of view
+        pawnRow = r + 1 if color == 'w' else r - 1
+        if 0 <= pawnRow < 8:
+            for pawnCol in (c - 1, c + 1):
+                if 0 <= pawnCol < 8 and self.board[pawnRow][pawnCol] == color + 'p' and (pawnRow, pawnCol) not in removed:
+                    return (pawnRow, pawnCol, 'p')
+
+        knightMoves = ((-2, -1), (-2, 1), (-1, -2), (-1, 2), (1, -2), (1, 2), (2, -1), (2, 1))
+        for m in knightMoves:
+            endRow = r + m[0]
+            endCol = c + m[1]
+            if 0 <= endRow < 8 and 0 <= endCol < 8:
+                if self.board[endRow][endCol] == color + 'N' and (endRow, endCol) not in removed:
+                    return (endRow, endCol, 'N')
+
+        #first piece seen in every direction, sliders are then picked from cheapest to most expensive
+        directions = ((-1, -1), (-1, 1), (1, -1), (1, 1), (-1, 0), (0, -1), (1, 0), (0, 1))
+        sliders = {'B': None, 'R': None, 'Q': None}
+        king = None
+        for j in range(len(directions)):
+            d = directions[j]
+            for i in range(1, 8):
+                endRow = r + d[0] * i
+                endCol = c + d[1] * i
+                if not (0 <= endRow < 8 and 0 <= endCol < 8): #off board
+                    break
+                endPiece = self.board[endRow][endCol]
+                if endPiece == "--" or (endRow, endCol) in removed:
+                    continue
+                if endPiece[0] == color:
+                    type = endPiece[1]
+                    if type == 'Q' or (type == 'B' and j <= 3) or (type == 'R' and j >= 4):
+                        if sliders[type] is None:
+                            sliders[type] = (endRow, endCol, type)
+                    elif type == 'K' and i == 1:
+                        king = (endRow, endCol, 'K')
+                break
+
+        for type in ('B', 'R', 'Q'):
+            if sliders[type] is not None:
+                return sliders[type]
+        return king
+
+    '''
+    Static exchange evaluation: the material balance (in pawns, from the point of view of the side making the move)
+    after both sides keep recapturing on the destination square with their least valuable attacker, each side being
+    allowed to stop when continuing would lose material. Pins are not taken into account.
+    A negative result means the move loses material, zero means it is an even trade (or a safe quiet move)
+    '''
+    def staticExchangeEvaluation(self, move):
+        r, c = move.endRow, move.endCol
+        removed = {(move.startRow, move.startCol)}
+        if move.isEnpassantMove:
+            removed.add((move.startRow, move.endCol))
+        gain = [seeValues[move.pieceCaptured[1]] if move.pieceCaptured != "--" else 0]
+        pieceOnSquare = move.pieceMoved[1]
+        if move.isPawnPromotion:
+            gain[0] += seeValues['Q'] - seeValues['p']
+            pieceOnSquare = 'Q'
+        color = 'b' if move.pieceMoved[0] == 'w' else 'w'
+
+        while True:
+            attacker = self.getLeastValuableAttacker(r, c, color, removed)
+            if attacker is None:
+                break
+            #the king can only recapture if the square is no longer defended
+            if attacker[2] == 'K' and self.getLeastValuableAttacker(r, c, 'w' if color == 'b' else 'b', removed | {attacker[:2]}) is not None:
+                break
+            gain.append(seeValues[pieceOnSquare] - gain[-1])
+            removed.add(attacker[:2])
+            pieceOnSquare = attacker[2]
+            color = 'w' if color == 'b' else 'b'
+
+        #every side chooses between standing pat and recapturing, going back from the end of the sequence
+        for i in range(len(gain) - 1, 0, -1):
+            gain[i - 1] = -max(-gain[i - 1], gain[i])
+        return gain[0]
+
+
+#piece values used by the static exchange evaluation, the king is worth more than anything it could win
+seeValues = {"K": 100, "Q": 9, "R": 5, "B": 3, "N": 3, "p": 1}
+
+
+#random numbers for the Zobrist hash, the seed is fixed so keys are the same in every process and every run
+zobristRandom = random.Random(20220101)
+zobristPieces = {color + type: [zobristRandom.getrandbits(64) for i in range(64)] for color in "wb" for type in "pNBRQK"}
+zobristPieces["--"] = [0] * 64 #empty squares don't change the key
+zobristBlackToMove = zobristRandom.getrandbits(64)
+zobristCastling = [zobristRandom.getrandbits(64) for i in range(16)]
+zobristEnpassant = [zobristRandom.getrandbits(64) for i in range(8)]
+
+#binary positions of GameState.toBytes: 4 bit codes for the pieces, 0 is an empty square
+codePieces = ["--", "wp", "wN", "wB", "wR", "wQ", "wK", "--", "--", "bp", "bN", "bB", "bR", "bQ", "bK", "--"]
+pieceCodes = {piece: code for code, piece in enumerate(codePieces) if piece != "--"}
+pieceCodes["--"] = 0
+#board, flags (side to move and castling rights), en passant square, halfmove clock, fullmove number, history length
+positionFormat = struct.Struct("<32sBBHHB")
+REPETITION_HISTORY = 100 #after 100 moves without a capture or pawn move the game is drawn anyway
+
 
 class CastleRights():
+    __slots__ = ("wks", "bks", "wqs", "bqs") #one of these is logged for every move, so no per instance dict
 
     def __init__(self, wks, bks, wqs, bqs):
         self.wks = wks
@@ -586,6 +951,12 @@ class CastleRights():
         self.wqs = wqs
         self.bqs = bqs
 
+    '''
+    Packs the four rights into a number from 0 to 15
+    '''
+    def getIndex(self):
+        return self.wks | self.bks << 1 | self.wqs << 2 | self.bqs << 3
+
 class Move():
 
     #maps keys to values
@@ -596,6 +967,10 @@ class Move():
     filesToCols = {"a": 0, "b": 1, "c": 2, "d": 3, "e": 4, "f": 5, "g": 6, "h": 7}
     colsToFiles = {v: k for k, v in filesToCols.items()}
 
+    #a game keeps every move it played in the move log, so no per instance dict
+    __slots__ = ("startRow", "startCol", "endRow", "endCol", "pieceMoved", "pieceCaptured", "castle", "isPawnPromotion",
+                 "isEnpassantMove", "isCapture", "isCastleMove", "moveID")
+
     def __init__(self, startSq, endSq, board, isEnpassantMove = False, castle= False):
         self.startRow = startSq[0]
         self.startCol = startSq[1]
@@ -4,44 +4,160 @@ the current GameState Object.
 """
 
 from multiprocessing.context import Process
-import pygame as p
+import json
+import os
+import threading
+import time
 import ChessEngine
 import ChessAI
 from multiprocessing import Process, Queue 
 
+#pygame is only imported by main(): with the spawn start method the AI process imports this file again,
+#and it only needs the engine
+p = None
+
 BOARD_WIDTH = BOARD_HEIGHT = 512  # 400 is another option for good resolution
 MOVE_LOG_PANEL_WIDTH = 270
 MOVE_LOG_PANEL_HEIGHT = BOARD_HEIGHT
 DIMENSION = 8  # dimensions of a chess board is an 8x8
 SQ_SIZE = BOARD_HEIGHT // DIMENSION
-MAX_FPS = 15 
+ANIMATION_FPS = 60 #frames per second while a move is animated, the rest of the time the loop sleeps until an event
+SECONDS_PER_SQUARE = 7 / 60 #how long the animation takes to move a piece by one square
+AI_MOVE_EVENT = None #posted by the thread waiting for the AI process when its move is ready, set by main()
 IMAGES = {}
+PIECES = ['wp', 'wR', 'wN', 'wB', 'wK', 'wQ', 'bp', 'bR', 'bN', 'bB', 'bK', 'bQ']
+ATLAS_DIRECTORY = "images/cache" #where the pre-scaled sprite sheet is kept between runs
+HIGHLIGHTS = {} #transparent overlays for highlighted squares, by color
+BOARD_IMAGE = None #the empty board, rendered once
+MOVES_PER_ROW = 3 #move pairs on one line of the move log
+
+#what was drawn at the last frame, so only what changed gets drawn again
+drawnSquares = None #(piece, highlight) of every square, None means the whole board has to be drawn
+drawnMoveLog = None #moves shown in the move log, None means the whole panel has to be drawn
+moveLogLines = [] #rendered lines of the move log with their y position
+drawnEndText = None
 
 '''
-Initialize a global dictionary of images. This will be called exactly once in the main
+Initialize a global dictionary of images. This will be called exactly once in the main.
+The pieces come from a single sprite sheet already scaled to SQ_SIZE, which is cached in ATLAS_DIRECTORY and
+only built again from the piece images when they change (or when SQ_SIZE changes)
 '''
 def loadImages():
-    pieces = ['wp', 'wR', 'wN', 'wB', 'wK',
-              'wQ', 'bp', 'bR', 'bN', 'bB', 'bK', 'bQ']
-    for piece in pieces:
-        IMAGES[piece] = p.transform.scale(p.image.load(
-            "images/" + piece + ".png"), (SQ_SIZE, SQ_SIZE))
+    atlasPath = os.path.join(ATLAS_DIRECTORY, "atlas_" + str(SQ_SIZE) + ".png")
+    manifestPath = os.path.join(ATLAS_DIRECTORY, "atlas_" + str(SQ_SIZE) + ".json")
+    sources = {}
+    for piece in PIECES:
+        stat = os.stat("images/" + piece + ".png")
+        sources[piece] = [stat.st_mtime_ns, stat.st_size]
+
+    atlas = None
+    try:
+        with open(manifestPath) as f:
+            if json.load(f) == sources:
+                atlas = p.image.load(atlasPath)
+    except (OSError, ValueError, p.error): #no cache yet, or a broken one
+        atlas = None
+    if atlas is None:
+        atlas = buildAtlas(atlasPath, manifestPath, sources)
+
+    atlas = atlas.convert_alpha() #same pixel format as the screen, so blits are fast
+    for i in range(len(PIECES)):
+        IMAGES[PIECES[i]] = atlas.subsurface(p.Rect(i*SQ_SIZE, 0, SQ_SIZE, SQ_SIZE))
     # Note: we can access an image by saying 'IMAGES['wp']'
 
 '''
-The main driver for our code. This will handle user input and updating the graphics
+Scale every piece image to SQ_SIZE and put them side by side on one surface, then save it with the sizes and
+modification times of the images it was made from. The cache is optional, the atlas is returned either way
+'''
+def buildAtlas(atlasPath, manifestPath, sources):
+    atlas = p.Surface((SQ_SIZE * len(PIECES), SQ_SIZE), p.SRCALPHA)
+    for i in range(len(PIECES)):
+        atlas.blit(p.transform.scale(p.image.load(
+            "images/" + PIECES[i] + ".png"), (SQ_SIZE, SQ_SIZE)), (i*SQ_SIZE, 0))
+    try:
+        os.makedirs(ATLAS_DIRECTORY, exist_ok=True)
+        #write to temporary files first so another window starting at the same time never reads half a file
+        temporaryAtlas = atlasPath[:-4] + "." + str(os.getpid()) + ".png"
+        p.image.save(atlas, temporaryAtlas)
+        os.replace(temporaryAtlas, atlasPath)
+        with open(manifestPath + "." + str(os.getpid()), "w") as f:
+            json.dump(sources, f)
+        os.replace(manifestPath + "." + str(os.getpid()), manifestPath)
+    except (OSError, p.error):
+        pass #read-only install, build it again next time
+    return atlas
+
+'''
+Render the parts of the screen that never change once: the empty board and the square highlights
+'''
+def prerender():
+    global BOARD_IMAGE
+    colors = [p.Color("white"), p.Color("gray")]
+    BOARD_IMAGE = p.Surface((BOARD_WIDTH, BOARD_HEIGHT))
+    for r in range(DIMENSION):
+        for c in range(DIMENSION):
+            color = colors[((r+c) % 2)]
+            p.draw.rect(BOARD_IMAGE, color, p.Rect(
+                c*SQ_SIZE, r*SQ_SIZE, SQ_SIZE, SQ_SIZE))
+    for color in ('blue', 'yellow'):
+        s = p.Surface((SQ_SIZE, SQ_SIZE))
+        s.set_alpha(100) #transparency value --> 0 transparent, 255 opaque
+        s.fill(p.Color(color))
+        HIGHLIGHTS[color] = s
+
+'''
+Forget what is on the screen so the next frame draws everything again
+'''
+def invalidate():
+    global drawnSquares, drawnMoveLog, drawnEndText
+    drawnSquares = None
+    drawnMoveLog = None
+    drawnEndText = None
+
+'''
+Forget what is on the squares under the rectangle so the next frame draws them again
+'''
+def invalidateRect(rect):
+    if drawnSquares is not None:
+        for r in range(max(rect.top // SQ_SIZE, 0), min((rect.bottom - 1) // SQ_SIZE + 1, DIMENSION)):
+            for c in range(max(rect.left // SQ_SIZE, 0), min((rect.right - 1) // SQ_SIZE + 1, DIMENSION)):
+                drawnSquares[r][c] = None
+
+'''
+Runs in a thread of the main process while the AI process is thinking, and wakes up the main loop with an
+AI_MOVE_EVENT once the move is in the queue
+'''
+def waitForAIMove(returnQueue, requestId):
+    AImove = returnQueue.get()
+    p.event.post(p.event.Event(AI_MOVE_EVENT, move=AImove, requestId=requestId))
+
+'''
+Stops the AI process, the thread waiting for it gets a None so it can finish too
+'''
+def stopAI(moveFinderProcess, returnQueue):
+    moveFinderProcess.terminate()
+    returnQueue.put(None)
+
+'''
+The main driver for our code. This will handle user input and updating the graphics.
+The loop sleeps until there is something to do: an input event, the move of the AI, or the next animation frame
 '''
 def main():
+    global p, AI_MOVE_EVENT
+    import pygame as p
+    AI_MOVE_EVENT = p.USEREVENT + 1
     p.init()
     screen = p.display.set_mode((BOARD_WIDTH + MOVE_LOG_PANEL_WIDTH, BOARD_HEIGHT))
-    clock = p.time.Clock()
     screen.fill(p.Color("white"))
     moveLogFont = p.font.SysFont("Arial", 16, False, False)
     gs = ChessEngine.GameState()
     validMoves = gs.getValidMoves()
     moveMade = False  #flag variable for when a move is made
     animate = False #flag variable for when we should animate a move
+    animation = None #the move being animated, with the time it started
     loadImages()  #only do this once, before the while loop
+    prerender()
+    invalidate()
     running = True
     sqSelected = ()  #no square is selected, keep track of the last click of the user (tuple: (row, col))
     #keep track of the player clicks (two tuples: [(6, 4), (4, 4)])
@@ -51,14 +167,19 @@ def main():
     playerTwo = False #if a human is playing black, then this will be True. if an AI is playing, then false
     AIthinking = False
     moveFinderProcess = None
+    returnQueue = None
+    AIrequestId = 0 #AI moves that arrive for an older request (after an undo or a reset) are ignored
     moveUndone = False
+    events = []
 
     while running:
         humanTurn = (gs.whiteToMove and playerOne) or (not gs.whiteToMove and playerTwo)
-        for e in p.event.get():
+        for e in events:
             if e.type == p.QUIT:
                 running = False
             # mouse handler
+            elif e.type == p.VIDEOEXPOSE: #the window was covered, its content is lost
+                invalidate()
             elif e.type == p.MOUSEBUTTONDOWN:
                 if not gameOver:
                     location = p.mouse.get_pos()  # (x,y) location of mouse
@@ -91,7 +212,7 @@ def main():
                     animate = False
                     gameOver = False
                     if AIthinking:
-                        moveFinderProcess.terminate()
+                        stopAI(moveFinderProcess, returnQueue)
                         AIthinking = False
                     moveUndone = True
 
@@ -102,152 +223,193 @@ def main():
                     playerClicks = []
                     moveMade = False
                     animate = False
+                    animation = None
                     gameOver = False
                     if AIthinking:
-                        moveFinderProcess.terminate()
+                        stopAI(moveFinderProcess, returnQueue)
                         AIthinking = False
                     moveUndone = True
-
-        #AI move finder
-        if not gameOver and not humanTurn and not moveUndone:
-            if not AIthinking:
-                AIthinking = True
-                returnQueue = Queue() #used to pass data between threads
-                moveFinderProcess = Process(target=ChessAI.findBestMove, args=(gs, validMoves, returnQueue))
-                moveFinderProcess.start() #calls findBestMove (gs, validMoves, returnQueue)
-            if not moveFinderProcess.is_alive():
-                AImove = returnQueue.get()
-                if AImove is None:
-                    AImove = ChessAI.findRandomMove(validMoves)
-                gs.makeMove(AImove)
-                moveMade = True
-                animate = True
-                AIthinking = False
+            # the AI process is done
+            elif e.type == AI_MOVE_EVENT:
+                if AIthinking and e.requestId == AIrequestId:
+                    AImove = e.move
+                    if AImove is None:
+                        AImove = ChessAI.findRandomMove(validMoves)
+                    gs.makeMove(AImove)
+                    moveMade = True
+                    animate = True
+                    AIthinking = False
 
         if moveMade:
-            if animate:
-                animateMove(gs.moveLog[-1], screen, gs.board, clock)
+            #the animation runs while the game goes on, a new move replaces the one being animated
+            animation = {"move": gs.moveLog[-1], "start": time.time()} if animate else None
             validMoves = gs.getValidMoves()
             moveMade = False
             animate = False
             moveUndone = False
 
-        drawGameState(screen, gs, validMoves, sqSelected, moveLogFont)
-
+        endText = None
         if gs.checkmate or gs.stalemate:
             gameOver = True
-            text = 'Stalemate' if gs.stalemate else 'Black wins by checkmate' if gs.whiteToMove else 'White wins by checkmate'
-            drawEndGameText(screen, text)
+            endText = 'Stalemate' if gs.stalemate else 'Black wins by checkmate' if gs.whiteToMove else 'White wins by checkmate'
 
-        clock.tick(MAX_FPS)
-        p.display.flip()
+        #AI move finder, the result comes back as an AI_MOVE_EVENT
+        humanTurn = (gs.whiteToMove and playerOne) or (not gs.whiteToMove and playerTwo)
+        if not gameOver and not humanTurn and not moveUndone and not AIthinking and running:
+            AIthinking = True
+            AIrequestId += 1
+            returnQueue = Queue() #used to pass data between threads
+            moveFinderProcess = Process(target=ChessAI.findBestMove, args=(gs.toBytes(), returnQueue))
+            moveFinderProcess.start() #calls findBestMove (position, returnQueue)
+            threading.Thread(target=waitForAIMove, args=(returnQueue, AIrequestId), daemon=True).start()
 
-'''
-Responsible for all the graphics within a current game state.
-'''
-def drawGameState(screen, gs, validMoves, sqSelected, moveLogFont):
-    drawBoard(screen)  # draw squares on the board
-    highlightSquares(screen, gs, validMoves, sqSelected)
-    drawPieces(screen, gs.board)  # draw pieces on top of those squares
-    drawMoveLog(screen, gs, moveLogFont)
+        if animation is not None:
+            dirtyRects = drawAnimationFrame(screen, gs, validMoves, sqSelected, moveLogFont, endText, animation)
+            if animation.get("done"):
+                animation = None
+        else:
+            dirtyRects = drawGameState(screen, gs, validMoves, sqSelected, moveLogFont, endText)
+        if dirtyRects:
+            p.display.update(dirtyRects) #only send the parts of the screen that changed
+
+        if not running:
+            break
+        if animation is not None:
+            events = [p.event.wait(1000 // ANIMATION_FPS)] #wake up for the next frame at the latest
+        else:
+            events = [p.event.wait()] #sleep until something happens
+        events += p.event.get()
+
+    if AIthinking:
+        stopAI(moveFinderProcess, returnQueue)
 
 '''
-Draw the squares on the board. The top left square is always light.
+Responsible for all the graphics within a current game state. Only the squares and move log lines that changed
+since the last frame are drawn, and their rectangles are returned so only they get updated on the display
 '''
-def drawBoard(screen):
-    global colors
-    colors = [p.Color("white"), p.Color("gray")]
-    for r in range(DIMENSION):
-        for c in range(DIMENSION):
-            color = colors[((r+c) % 2)]
-            p.draw.rect(screen, color, p.Rect(
-                c*SQ_SIZE, r*SQ_SIZE, SQ_SIZE, SQ_SIZE))
+def drawGameState(screen, gs, validMoves, sqSelected, moveLogFont, endText=None, board=None):
+    global drawnEndText
+    if endText != drawnEndText and drawnEndText is not None: #the text is going away, the board under it must be redrawn
+        invalidate()
+    dirtyRects = drawSquares(screen, board if board is not None else gs.board, highlightSquares(gs, validMoves, sqSelected))
+    dirtyRects += drawMoveLog(screen, gs, moveLogFont)
+    if endText is not None and (endText != drawnEndText or dirtyRects):
+        dirtyRects.append(drawEndGameText(screen, endText))
+    drawnEndText = endText
+    return dirtyRects
 
 '''
-Highlight the square selected and moves for piece selected
+Find the squares to highlight: the square selected and the moves of the piece selected
 '''
-def highlightSquares(screen, gs, validMoves, sqSelected):
+def highlightSquares(gs, validMoves, sqSelected):
+    highlights = {}
     if sqSelected != ():
         r, c =sqSelected
         if gs.board[r][c][0] == ('w' if gs.whiteToMove else 'b'): #sqSelected is a piece that can be moved
-            #highlight selected square
-            s = p.Surface((SQ_SIZE, SQ_SIZE))
-            s.set_alpha(100) #transparency value --> 0 transparent, 255 opaque
-            s.fill(p.Color('blue'))
-            screen.blit(s, (c*SQ_SIZE, r*SQ_SIZE))
-            #highlight moves from that square
-            s.fill(p.Color('yellow'))
+            highlights[(r, c)] = 'blue'
             for move in validMoves:
                 if move.startRow == r and move.startCol == c:
-                    screen.blit(s, (SQ_SIZE*move.endCol, SQ_SIZE*move.endRow))
+                    highlights[(move.endRow, move.endCol)] = 'yellow'
+    return highlights
 
 '''
-Draw the pieces on the board using the current GameState.board
+Draw the squares whose piece or highlight changed since the last frame and return their rectangles
 '''
-def drawPieces(screen, board):
+def drawSquares(screen, board, highlights):
+    global drawnSquares
+    if drawnSquares is None:
+        drawnSquares = [[None] * DIMENSION for r in range(DIMENSION)]
+    dirtyRects = []
     for r in range(DIMENSION):
         for c in range(DIMENSION):
-            piece = board[r][c]
-            if piece != "--":  # not empty square
-                screen.blit(IMAGES[piece], p.Rect(
-                    c*SQ_SIZE, r*SQ_SIZE, SQ_SIZE, SQ_SIZE))
+            square = (board[r][c], highlights.get((r, c)))
+            if square != drawnSquares[r][c]:
+                drawnSquares[r][c] = square
+                rect = p.Rect(c*SQ_SIZE, r*SQ_SIZE, SQ_SIZE, SQ_SIZE)
+                screen.blit(BOARD_IMAGE, rect, rect) #the empty square
+                if square[1] is not None:
+                    screen.blit(HIGHLIGHTS[square[1]], rect)
+                if square[0] != "--":
+                    screen.blit(IMAGES[square[0]], rect)
+                dirtyRects.append(rect)
+    return dirtyRects
 
 '''
-Draws the move log
+The text of one line of the move log, e.g. "1. e4 e5  2. Nf3 Nc6  3. Bb5 a6  "
 '''
-def drawMoveLog(screen, gs, font):
-    moveLogRect = p.Rect(BOARD_WIDTH, 0, MOVE_LOG_PANEL_WIDTH, MOVE_LOG_PANEL_HEIGHT)
-    p.draw.rect(screen, p.Color("Black"), moveLogRect)
-    moveLog = gs.moveLog
-    moveTexts = []
-    for i in range(0, len(moveLog), 2):
-        moveString = str(i//2 + 1) + ". " + str(moveLog[i]) + " "
+def getMoveLogLine(moveLog, line):
+    text = ""
+    for i in range(line * MOVES_PER_ROW * 2, min((line + 1) * MOVES_PER_ROW * 2, len(moveLog)), 2):
+        text += str(i//2 + 1) + ". " + str(moveLog[i]) + " "
         if i + 1 < len(moveLog): #make sure black made a move
-            moveString += str(moveLog[i + 1]) + "  "
-        moveTexts.append(moveString)
+            text += str(moveLog[i + 1]) + "  "
+    return text
 
-    movesPerRow = 3
+'''
+Draws the move log. Lines that are already on the screen are kept, only the lines from the first move that changed
+(a new move, or an undone one) are rendered again
+'''
+def drawMoveLog(screen, gs, font):
+    global drawnMoveLog
+    moveLog = gs.moveLog
     padding = 5
-    textY = padding
     lineSpacing = 2
-    for i in range(0, len(moveTexts), movesPerRow):
-        text = ""
-        for j in range(movesPerRow):
-            if i + j < len(moveTexts):
-                text += moveTexts[i + j]
-        textObject = font.render(text, True, p.Color('white'))
-        textLocation = moveLogRect.move(padding, textY)
-        screen.blit(textObject, textLocation)
+    if drawnMoveLog is not None and len(drawnMoveLog) == len(moveLog) and (len(moveLog) == 0 or drawnMoveLog[-1] is moveLog[-1]):
+        return [] #nothing changed
+    if drawnMoveLog is None:
+        firstChange = 0
+    else:
+        firstChange = 0
+        while firstChange < min(len(drawnMoveLog), len(moveLog)) and drawnMoveLog[firstChange] is moveLog[firstChange]:
+            firstChange += 1
+    firstLine = firstChange // (MOVES_PER_ROW * 2)
+    del moveLogLines[firstLine:]
+    textY = moveLogLines[-1][1] + moveLogLines[-1][0].get_height() + lineSpacing if moveLogLines else padding
+    if firstLine == 0:
+        textY = 0 #clear the top padding too
+    dirtyRect = p.Rect(BOARD_WIDTH, textY, MOVE_LOG_PANEL_WIDTH, MOVE_LOG_PANEL_HEIGHT - textY)
+    p.draw.rect(screen, p.Color("Black"), dirtyRect)
+    textY = max(textY, padding)
+
+    for line in range(firstLine, (len(moveLog) + MOVES_PER_ROW * 2 - 1) // (MOVES_PER_ROW * 2)):
+        textObject = font.render(getMoveLogLine(moveLog, line), True, p.Color('white'))
+        screen.blit(textObject, (BOARD_WIDTH + padding, textY))
+        moveLogLines.append((textObject, textY))
         textY += textObject.get_height() + lineSpacing
+    drawnMoveLog = list(moveLog)
+    return [dirtyRect]
 
 '''
-Animating a move
+Animating a move: draws the frame for the time elapsed since the animation started. The move is already made on
+the board, so the end square shows the captured piece until the moving piece gets there. The squares under the
+moving piece are drawn again at the next frame. Sets animation["done"] once the piece has arrived
 '''
-def animateMove(move, screen, board, clock):
-    global colors
+def drawAnimationFrame(screen, gs, validMoves, sqSelected, moveLogFont, endText, animation):
+    move = animation["move"]
     dR = move.endRow - move.startRow
     dC = move.endCol - move.startCol
-    framesPerSquare = 7 #frames to move one square
-    frameCount = ((abs(dR) + abs(dC)) * framesPerSquare)
-    for frame in range(frameCount + 1):
-        r, c = (move.startRow + dR * frame/frameCount, move.startCol + dC * frame/frameCount)
-        drawBoard(screen)
-        drawPieces(screen, board)
-        #erase the piece moved from its ending square
-        color = colors[(move.endRow + move.endCol) % 2]
-        endSquare = p.Rect(move.endCol*SQ_SIZE, move.endRow*SQ_SIZE,SQ_SIZE,SQ_SIZE)
-        p.draw.rect(screen, color, endSquare)
-        #draw captured piece onto rectangle
-        if move.pieceCaptured != "--":
-            if move.isEnpassantMove:
-                enPassantRow = (move.endRow + 1) if move.pieceCaptured[0] == 'b' else (move.endRow - 1)
-                endSquare = p.Rect(move.endCol*SQ_SIZE, enPassantRow*SQ_SIZE,SQ_SIZE,SQ_SIZE)
-
-            screen.blit(IMAGES[move.pieceCaptured], endSquare)
-        #draw moving piece
-        screen.blit(IMAGES[move.pieceMoved], p.Rect(c*SQ_SIZE, r*SQ_SIZE, SQ_SIZE, SQ_SIZE))
-        p.display.flip()
-        clock.tick(60)
+    duration = (abs(dR) + abs(dC)) * SECONDS_PER_SQUARE
+    progress = min((time.time() - animation["start"]) / duration, 1)
+    if progress >= 1:
+        animation["done"] = True
+        return drawGameState(screen, gs, validMoves, sqSelected, moveLogFont, endText)
+
+    board = [row[:] for row in gs.board]
+    board[move.endRow][move.endCol] = "--"
+    #draw captured piece onto its square
+    if move.pieceCaptured != "--":
+        if move.isEnpassantMove:
+            board[move.startRow][move.endCol] = move.pieceCaptured
+        else:
+            board[move.endRow][move.endCol] = move.pieceCaptured
+    dirtyRects = drawGameState(screen, gs, validMoves, sqSelected, moveLogFont, endText, board)
+    #draw moving piece
+    r, c = (move.startRow + dR * progress, move.startCol + dC * progress)
+    animation["rect"] = p.Rect(round(c*SQ_SIZE), round(r*SQ_SIZE), SQ_SIZE, SQ_SIZE)
+    screen.blit(IMAGES[move.pieceMoved], animation["rect"])
+    dirtyRects.append(animation["rect"])
+    invalidateRect(animation["rect"])
+    return dirtyRects
 
 def drawEndGameText(screen, text):
     font = p.font.SysFont("Helvitca", 32, True, False)
@@ -256,6 +418,7 @@ def drawEndGameText(screen, text):
     screen.blit(textObject, textLocation)
     textObject = font.render(text,0, p.Color("Black"))
     screen.blit(textObject, textLocation.move(2, 2))
+    return p.Rect(textLocation.x, textLocation.y, textObject.get_width() + 2, textObject.get_height() + 2)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
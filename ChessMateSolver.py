@@ -0,0 +1,234 @@
+"""
+This file is responsible for solving forced mates ("mate in N" puzzles). It uses depth-first proof-number search
+(df-pn): instead of searching every reply to the same depth, it keeps working on the moves that look closest to
+being proven. Checks are tried first, the ones that leave the defender the fewest replies before the others.
+Given a move limit it either returns a mating line or proves that no mate exists within that many moves.
+
+Run it with: python ChessMateSolver.py "r2qkb1r/pp2nppp/3p4/2pNN1B1/2BnP3/3P4/PPP2PPP/R2bK2R w KQkq - 1 10" --moves 2
+"""
+
+import argparse
+import time
+import ChessEngine
+
+INFINITY = 10 ** 9 #proof or disproof number of a position that can't be proven (or disproven)
+HASH_SIZE = 32 #megabytes used by the table of proof and disproof numbers
+HASH_ENTRY_SIZE = 150 #rough number of bytes one entry of the table takes in memory
+QUIET_MOVE_PROOF_NUMBER = 10 #proof number a move that doesn't give check starts with, a check starts with its replies
+
+MATE = "mate"
+NO_MATE = "no mate"
+UNKNOWN = "unknown" #the node limit was reached first
+
+'''
+Raised inside the search when it runs out of nodes, the position is restored by solve
+'''
+class SolverAborted(Exception):
+    pass
+
+'''
+Proof-number search for a mate by the side to move of gs. The table of proof and disproof numbers is kept between
+calls to solve, as long as they are for the same attacking side
+'''
+class MateSolver():
+
+    def __init__(self, gs, hashSize=HASH_SIZE):
+        self.gs = gs
+        self.table = {} #(zobrist key, attacker moves left) -> (proof number, disproof number, nodes spent on it)
+        self.maxEntries = max(1024, hashSize * 1024 * 1024 // HASH_ENTRY_SIZE)
+        self.attackerIsWhite = gs.whiteToMove
+        self.nodes = 0
+        self.maxNodes = None
+
+    '''
+    Looks for a mate in at most maxMoves moves of the attacker, shortest first. Returns (MATE, mating line as a list
+    of moves, nodes), (NO_MATE, [], nodes) once it is proven there is none, or (UNKNOWN, [], nodes) if maxNodes
+    ran out first
+    '''
+    def solve(self, maxMoves, maxNodes=None):
+        if self.gs.whiteToMove != self.attackerIsWhite:
+            self.table.clear()
+            self.attackerIsWhite = self.gs.whiteToMove
+        self.nodes = 0
+        self.maxNodes = maxNodes
+        plyCount = len(self.gs.moveLog)
+        try:
+            for moves in range(1, maxMoves + 1):
+                proofNumber, disproofNumber = self.prove(moves)
+                if proofNumber == 0:
+                    return MATE, self.getLine(moves), self.nodes
+        except SolverAborted:
+            while len(self.gs.moveLog) > plyCount: #take back the moves of the unfinished line
+                self.gs.undoMove()
+            return UNKNOWN, [], self.nodes
+        return NO_MATE, [], self.nodes
+
+    '''
+    Runs the search on the current position until it is proven or disproven, returns its proof and disproof numbers
+    '''
+    def prove(self, movesLeft):
+        key = (self.gs.zobristKey, movesLeft)
+        entry = self.table.get(key)
+        if entry is None or (entry[0] != 0 and entry[1] != 0):
+            self.search(movesLeft, INFINITY, INFINITY)
+            entry = self.table[key]
+        return entry[0], entry[1]
+
+    '''
+    The df-pn search of the current position. movesLeft is the number of moves the attacker still has, counting
+    the one it is about to play if it is its turn. Works on the position until its phi reaches thresholdPhi or its
+    delta reaches thresholdDelta, where phi and delta are the proof and disproof numbers from the point of view of
+    the side to move (phi is the proof number for the attacker, the disproof number for the defender)
+    '''
+    def search(self, movesLeft, thresholdPhi, thresholdDelta):
+        gs = self.gs
+        self.nodes += 1
+        if self.maxNodes is not None and self.nodes > self.maxNodes:
+            raise SolverAborted()
+        startNodes = self.nodes
+        attackerToMove = gs.whiteToMove == self.attackerIsWhite
+        key = (gs.zobristKey, movesLeft)
+        entry = self.table.get(key)
+        work = entry[2] if entry is not None else 0
+
+        #the children with their proof and disproof numbers to use while they are not in the table
+        children = []
+        validMoves = gs.getValidMoves()
+        for move in validMoves:
+            gs.makeMove(move)
+            if attackerToMove:
+                if not gs.checkforPinsAndchecks()[0]:
+                    #the last move has to give check, and counting the replies to quiet moves costs too much
+                    numbers = (INFINITY, 0) if movesLeft == 1 else (QUIET_MOVE_PROOF_NUMBER, 1)
+                    children.append((move, (gs.zobristKey, movesLeft - 1), numbers))
+                    gs.undoMove()
+                    continue
+                replies = gs.getValidMoves()
+                if len(replies) == 0:
+                    numbers = (0, INFINITY) if gs.checkmate else (INFINITY, 0) #mate, or stalemate
+                elif movesLeft == 1:
+                    numbers = (INFINITY, 0) #it was the last move and it is not mate
+                else:
+                    numbers = (len(replies), 1) #the fewer the replies, the easier to prove
+                children.append((move, (gs.zobristKey, movesLeft - 1), numbers))
+            else:
+                children.append((move, (gs.zobristKey, movesLeft), (1, 1)))
+            gs.undoMove()
+
+        while True:
+            phi = INFINITY #smallest delta of the children
+            delta = 0 #sum of the phis of the children
+            secondDelta = INFINITY
+            best = None
+            for i in range(len(children)):
+                entry = self.table.get(children[i][1])
+                proofNumber, disproofNumber = entry[:2] if entry is not None else children[i][2]
+                childPhi, childDelta = (disproofNumber, proofNumber) if attackerToMove else (proofNumber, disproofNumber)
+                delta = min(INFINITY, delta + childPhi)
+                if childDelta < phi:
+                    secondDelta = phi
+                    phi = childDelta
+                    best = i
+                    bestPhi = childPhi
+                elif childDelta < secondDelta:
+                    secondDelta = childDelta
+            if len(children) == 0: #no moves: the attacker can't mate, the defender is mated or stalemated
+                phi, delta = (0, INFINITY) if gs.stalemate and not attackerToMove else (INFINITY, 0)
+            if phi >= thresholdPhi or delta >= thresholdDelta or phi == 0 or delta == 0:
+                break
+            gs.makeMove(children[best][0])
+            self.search(children[best][1][1], thresholdDelta + bestPhi - delta, min(thresholdPhi, secondDelta + 1))
+            gs.undoMove()
+
+        if len(self.table) >= self.maxEntries:
+            self.collectGarbage()
+        work += self.nodes - startNodes + 1
+        self.table[key] = (phi, delta, work) if attackerToMove else (delta, phi, work)
+
+    '''
+    Makes room in the table by forgetting the half of the positions that took the least work to solve
+    '''
+    def collectGarbage(self):
+        entries = sorted(self.table.items(), key=lambda item: item[1][2])
+        for key, entry in entries[:len(entries) // 2]:
+            del self.table[key]
+
+    '''
+    Follows the proven moves from the current position to the mate. The attacker plays a move that is proven to
+    mate and the defender the reply that took the most work to prove. Positions that were dropped from the table
+    are proven again
+    '''
+    def getLine(self, movesLeft):
+        gs = self.gs
+        line = []
+        while True:
+            validMoves = gs.getValidMoves()
+            if len(validMoves) == 0:
+                break
+            chosen = None
+            if gs.whiteToMove == self.attackerIsWhite:
+                for proveAgain in (False, True): #the table is tried first, proving a move can take a while
+                    for move in validMoves:
+                        gs.makeMove(move)
+                        gs.getValidMoves()
+                        if gs.checkmate:
+                            proven = True
+                        elif gs.stalemate or movesLeft == 1:
+                            proven = False
+                        elif proveAgain:
+                            proven = self.prove(movesLeft - 1)[0] == 0
+                        else:
+                            entry = self.table.get((gs.zobristKey, movesLeft - 1))
+                            proven = entry is not None and entry[0] == 0
+                        gs.undoMove()
+                        if proven:
+                            chosen = move
+                            break
+                    if chosen is not None:
+                        break
+                movesLeft -= 1
+            else:
+                mostWork = -1
+                for move in validMoves:
+                    gs.makeMove(move)
+                    entry = self.table.get((gs.zobristKey, movesLeft))
+                    gs.undoMove()
+                    if entry is not None and entry[2] > mostWork:
+                        chosen = move
+                        mostWork = entry[2]
+                if chosen is None: #the replies were all dropped from the table, every one of them gets mated
+                    chosen = validMoves[0]
+            line.append(chosen)
+            gs.makeMove(chosen)
+        for move in line:
+            gs.undoMove()
+        return line
+
+def main():
+    import ChessPGN
+    parser = argparse.ArgumentParser(description="Finds a forced mate or proves there is none")
+    parser.add_argument("fen", help="position to solve, the side to move is the one trying to mate")
+    parser.add_argument("--moves", type=int, default=3, help="look for a mate in at most this many moves")
+    parser.add_argument("--nodes", type=int, help="give up after searching this many positions")
+    parser.add_argument("--hash", type=int, default=HASH_SIZE, help="megabytes for the table of the search")
+    args = parser.parse_args()
+
+    gs = ChessEngine.GameState()
+    gs.loadFEN(args.fen)
+    startTime = time.time()
+    result, line, nodes = MateSolver(gs, args.hash).solve(args.moves, args.nodes)
+    elapsed = time.time() - startTime
+    if result == MATE:
+        notation = []
+        for move in line:
+            notation.append(ChessPGN.moveToSAN(gs, move, gs.getValidMoves()))
+            gs.makeMove(move)
+        print("Mate in %d: %s" % ((len(line) + 1) // 2, " ".join(notation)))
+    elif result == NO_MATE:
+        print("No mate in %d or less" % args.moves)
+    else:
+        print("Not solved within %d nodes" % args.nodes)
+    print("%d nodes, %.2f s" % (nodes, elapsed))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,318 @@
+"""
+This file is responsible for the neural network evaluation, in the style of NNUE (efficiently updatable neural
+network). Every piece on a square is an input of the network. The first layer adds up a row of weights for each
+piece on the board, and that sum (the accumulator) is kept up to date by makeMove and undoMove: a move only adds
+and takes away the rows of the few pieces it moves, so it costs a handful of small NumPy additions. Evaluating a
+position is then one clipped multiply of the accumulator by the output weights.
+The weights are integers (quantized), and the accumulator is kept from the point of view of both players so the
+network always looks at the position from the side to move.
+
+It needs numpy. The AI only uses it when USE_NNUE is set in ChessAI.py and the network file exists.
+
+Make a network with: python ChessNNUE.py selfplay --games 200 --output selfplay.npz
+                     python ChessNNUE.py train selfplay.npz --output nnue.npz
+"""
+
+import argparse
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import ChessEngine
+import ChessAI
+
+PIECE_TYPES = "pNBRQK"
+INPUTS = 2 * 6 * 64 #own and opponent pieces of every type on every square
+HIDDEN = 64 #size of the accumulator of each player
+MAX_FEATURES = 32 #pieces on the board at most
+QA = 255 #the accumulator is clipped to 0..QA, 1.0 in the trained network
+QB = 64 #scale of the output weights
+SIGMOID_SCALE = 4.0 #pawns of advantage that make a win about 73% likely when training
+MAX_PLIES = 300 #self-play games still going after this many plies are counted as draws
+VERSION = 1
+
+networks = {} #file name -> Network, or None if there is no file
+
+'''
+The input of a piece on a square from the point of view of one player: the player's own pieces come first and
+the board is mirrored for black, so both players see themselves playing up the board
+'''
+def featureIndex(piece, square, perspective):
+    own = piece[0] == perspective
+    square = square if perspective == 'w' else square ^ 56
+    return ((0 if own else 6) + PIECE_TYPES.index(piece[1])) * 64 + square
+
+'''
+The inputs of the pieces of the position for white and for black, padded with INPUTS (an input that is never on)
+up to MAX_FEATURES so the positions can be stacked in arrays for training
+'''
+def getFeatures(gs):
+    features = {'w': [], 'b': []}
+    for r in range(8):
+        for c in range(8):
+            if gs.board[r][c] != "--":
+                for perspective in "wb":
+                    features[perspective].append(featureIndex(gs.board[r][c], r * 8 + c, perspective))
+    for perspective in "wb":
+        features[perspective] += [INPUTS] * (MAX_FEATURES - len(features[perspective]))
+    return features['w'], features['b']
+
+'''
+A quantized network, ready to evaluate positions
+'''
+class Network():
+
+    def __init__(self, featureWeights, featureBias, outputWeights, outputBias):
+        hidden = featureBias.shape[0]
+        #for every piece, the rows of weights it adds on each square, from white's point of view then black's
+        self.pieceWeights = {}
+        for color in "wb":
+            for pieceType in PIECE_TYPES:
+                piece = color + pieceType
+                rows = [featureWeights[[featureIndex(piece, square, perspective) for square in range(64)]] for perspective in "wb"]
+                self.pieceWeights[piece] = np.stack(rows, axis=1).astype(np.int32)
+        self.bias = np.stack([featureBias, featureBias]).astype(np.int32)
+        outputWeights = outputWeights.astype(np.int64)
+        #output weights lined up with the (white, black) rows of the accumulator, for white to move and black to move
+        self.outputForSide = {True: np.stack([outputWeights[:hidden], outputWeights[hidden:]]),
+                              False: np.stack([outputWeights[hidden:], outputWeights[:hidden]])}
+        self.outputBias = int(outputBias)
+
+    def newAccumulator(self, gs):
+        return Accumulator(self, gs)
+
+'''
+The first layer of the network for a GameState, updated by makeMove and undoMove once it is set as gs.accumulator
+'''
+class Accumulator():
+
+    def __init__(self, network, gs):
+        self.network = network
+        self.clipped = np.empty(network.bias.shape, dtype=np.int64) #QA * QB * hidden overflows 32 bits past 256 neurons
+        self.refresh(gs)
+
+    '''
+    Computes the accumulator again from the board
+    '''
+    def refresh(self, gs):
+        values = self.network.bias.copy()
+        for r in range(8):
+            for c in range(8):
+                if gs.board[r][c] != "--":
+                    values += self.network.pieceWeights[gs.board[r][c]][r * 8 + c]
+        self.values = values
+        self.stack = [] #accumulators before each move, undoMove puts them back
+
+    '''
+    Called by makeMove once the move is on the board
+    '''
+    def makeMove(self, move):
+        weights = self.network.pieceWeights
+        self.stack.append(self.values)
+        values = self.values - weights[move.pieceMoved][move.startRow * 8 + move.startCol] #a new array, the old one stays on the stack
+        values += weights[move.pieceMoved[0] + 'Q' if move.isPawnPromotion else move.pieceMoved][move.endRow * 8 + move.endCol]
+        if move.isEnpassantMove:
+            values -= weights[move.pieceCaptured][move.startRow * 8 + move.endCol]
+        elif move.pieceCaptured != "--":
+            values -= weights[move.pieceCaptured][move.endRow * 8 + move.endCol]
+        if move.isCastleMove:
+            rook = weights[move.pieceMoved[0] + 'R']
+            if move.endCol - move.startCol == 2: #king side
+                values += rook[move.endRow * 8 + move.endCol - 1] - rook[move.endRow * 8 + move.endCol + 1]
+            else:
+                values += rook[move.endRow * 8 + move.endCol + 1] - rook[move.endRow * 8 + move.endCol - 2]
+        self.values = values
+
+    def undoMove(self):
+        self.values = self.stack.pop()
+
+    '''
+    The score of the position in pawns, positive when it is good for white like ChessAI.scoreBoard
+    '''
+    def evaluate(self, whiteToMove):
+        np.clip(self.values, 0, QA, out=self.clipped)
+        score = (int(np.vdot(self.clipped, self.network.outputForSide[whiteToMove])) + self.network.outputBias) / (QA * QB)
+        return score if whiteToMove else -score
+
+'''
+Loads a network written by saveNetwork. Returns None if the file is missing, raises a ValueError if it is not a
+network of this version
+'''
+def loadNetwork(path):
+    if path in networks:
+        return networks[path]
+    if not os.path.exists(path):
+        networks[path] = None
+        return None
+    with np.load(path) as data:
+        try:
+            if int(data["version"]) != VERSION:
+                raise ValueError("network file has another version: " + path)
+            featureWeights, featureBias = data["featureWeights"], data["featureBias"]
+            outputWeights, outputBias = data["outputWeights"], data["outputBias"]
+        except KeyError:
+            raise ValueError("not a network file: " + path)
+    hidden = featureBias.shape[0]
+    if featureWeights.shape != (INPUTS, hidden) or outputWeights.shape != (2 * hidden,):
+        raise ValueError("network file has the wrong shape: " + path)
+    networks[path] = Network(featureWeights, featureBias, outputWeights, outputBias)
+    return networks[path]
+
+def saveNetwork(path, featureWeights, featureBias, outputWeights, outputBias):
+    np.savez(path, version=VERSION, featureWeights=featureWeights.astype(np.int16), featureBias=featureBias.astype(np.int16),
+             outputWeights=outputWeights.astype(np.int16), outputBias=np.int32(outputBias))
+
+'''
+Plays one game of the engine against itself and returns the positions it went through, with the score the search
+gave them and the result of the game, both for the side to move. task is (seed, depth, random plies).
+The first moves are random so the games don't all repeat each other
+'''
+def playSelfPlayGame(task):
+    seed, depth, randomPlies = task
+    rng = random.Random(seed)
+    gs = ChessEngine.GameState()
+    positions = []
+    positionCounts = {}
+    result = 0.5 #for white, draws and adjudicated games count as draws
+    while len(gs.moveLog) < MAX_PLIES:
+        validMoves = gs.getValidMoves()
+        if gs.checkmate:
+            result = 0.0 if gs.whiteToMove else 1.0
+            break
+        if gs.stalemate or gs.getHalfmoveClock() >= 100:
+            break
+        position = gs.getFEN().rsplit(" ", 2)[0]
+        positionCounts[position] = positionCounts.get(position, 0) + 1
+        if positionCounts[position] >= 3:
+            break
+        if len(gs.moveLog) < randomPlies:
+            move = rng.choice(validMoves)
+        else:
+            ChessAI.transpositionTable.clear()
+            move, score, nodes = ChessAI.searchPosition(gs, validMoves, depth)
+            if move is None:
+                move = validMoves[0]
+            elif not gs.inCheck and abs(score) < ChessAI.BITBASE_WIN / 2: #quiet positions with real scores only
+                whiteFeatures, blackFeatures = getFeatures(gs)
+                positions.append((whiteFeatures, blackFeatures, gs.whiteToMove, score))
+        gs.makeMove(move)
+    return [(whiteFeatures, blackFeatures, whiteToMove, score, result if whiteToMove else 1 - result)
+            for whiteFeatures, blackFeatures, whiteToMove, score in positions]
+
+def selfPlay(games, depth, randomPlies, workers, output, seed):
+    startTime = time.time()
+    positions = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for gamePositions in pool.map(playSelfPlayGame, [(seed + i, depth, randomPlies) for i in range(games)]):
+            positions.extend(gamePositions)
+    np.savez_compressed(output, white=np.array([p[0] for p in positions], dtype=np.int16).reshape(-1, MAX_FEATURES),
+                        black=np.array([p[1] for p in positions], dtype=np.int16).reshape(-1, MAX_FEATURES),
+                        whiteToMove=np.array([p[2] for p in positions], dtype=bool),
+                        score=np.array([p[3] for p in positions], dtype=np.float32),
+                        result=np.array([p[4] for p in positions], dtype=np.float32))
+    print("%d games, %d positions, %.1f s" % (games, len(positions), time.time() - startTime))
+
+def sigmoid(x):
+    return 1 / (1 + np.exp(-x))
+
+'''
+Trains a network in floating point on the self-play files with Adam, then quantizes and saves it. The target of
+a position mixes the search score and the game result, resultWeight says how much of it is the result
+'''
+def train(dataFiles, output, hidden, epochs, batchSize, learningRate, resultWeight, seed):
+    rng = np.random.default_rng(seed)
+    data = [np.load(path) for path in dataFiles]
+    white = np.concatenate([d["white"] for d in data]).astype(np.int64)
+    black = np.concatenate([d["black"] for d in data]).astype(np.int64)
+    whiteToMove = np.concatenate([d["whiteToMove"] for d in data])
+    ours = np.where(whiteToMove[:, None], white, black) #inputs from the point of view of the side to move
+    theirs = np.where(whiteToMove[:, None], black, white)
+    target = (1 - resultWeight) * sigmoid(np.concatenate([d["score"] for d in data]) / SIGMOID_SCALE) + \
+             resultWeight * np.concatenate([d["result"] for d in data])
+    count = len(target)
+    if count == 0:
+        raise ValueError("no positions to train on")
+    order = rng.permutation(count)
+    validation = order[:max(1, count // 20)]
+    training = order[len(validation):]
+
+    #the parameters, the weights of input INPUTS stay 0 since it is the padding
+    parameters = {"featureWeights": rng.normal(0, 0.1, (INPUTS + 1, hidden)).astype(np.float32),
+                  "featureBias": np.full(hidden, 0.5, dtype=np.float32),
+                  "outputWeights": rng.normal(0, 0.1, 2 * hidden).astype(np.float32),
+                  "outputBias": np.zeros(1, dtype=np.float32)}
+    parameters["featureWeights"][INPUTS] = 0
+    moments = {name: (np.zeros_like(value), np.zeros_like(value)) for name, value in parameters.items()}
+    limits = {"featureWeights": 32767 / QA, "featureBias": 32767 / QA, "outputWeights": 32767 / QB, "outputBias": 1e6}
+
+    def forward(batch):
+        accumulators = [parameters["featureWeights"][features[batch]].sum(axis=1) + parameters["featureBias"]
+                        for features in (ours, theirs)]
+        activations = [np.clip(accumulator, 0, 1) for accumulator in accumulators]
+        out = activations[0] @ parameters["outputWeights"][:hidden] + activations[1] @ parameters["outputWeights"][hidden:] + \
+              parameters["outputBias"][0]
+        return accumulators, activations, sigmoid(out / SIGMOID_SCALE)
+
+    step = 0
+    for epoch in range(1, epochs + 1):
+        startTime = time.time()
+        rng.shuffle(training)
+        for start in range(0, len(training), batchSize):
+            batch = training[start:start + batchSize]
+            accumulators, activations, prediction = forward(batch)
+            dOut = 2 * (prediction - target[batch]) * prediction * (1 - prediction) / SIGMOID_SCALE / len(batch)
+            gradients = {"outputWeights": np.concatenate([activations[0].T @ dOut, activations[1].T @ dOut]),
+                         "outputBias": np.array([dOut.sum()]),
+                         "featureBias": np.zeros(hidden, dtype=np.float32),
+                         "featureWeights": np.zeros_like(parameters["featureWeights"])}
+            for side, features in enumerate((ours, theirs)):
+                outputWeights = parameters["outputWeights"][side * hidden:(side + 1) * hidden]
+                dAccumulator = dOut[:, None] * outputWeights * ((accumulators[side] > 0) & (accumulators[side] < 1))
+                gradients["featureBias"] += dAccumulator.sum(axis=0)
+                np.add.at(gradients["featureWeights"], features[batch], dAccumulator[:, None, :])
+            gradients["featureWeights"][INPUTS] = 0
+            step += 1
+            for name, gradient in gradients.items(): #Adam
+                first, second = moments[name]
+                first *= 0.9
+                first += 0.1 * gradient
+                second *= 0.999
+                second += 0.001 * gradient * gradient
+                parameters[name] -= learningRate * (first / (1 - 0.9 ** step)) / (np.sqrt(second / (1 - 0.999 ** step)) + 1e-8)
+                np.clip(parameters[name], -limits[name], limits[name], out=parameters[name])
+        loss = float(np.mean((forward(validation)[2] - target[validation]) ** 2))
+        print("epoch %d: validation loss %.5f, %.1f s" % (epoch, loss, time.time() - startTime), flush=True)
+
+    saveNetwork(output, np.round(parameters["featureWeights"][:INPUTS] * QA), np.round(parameters["featureBias"] * QA),
+                np.round(parameters["outputWeights"] * QB), round(float(parameters["outputBias"][0]) * QA * QB))
+    print("%d positions, network written to %s" % (count, output))
+
+def main():
+    parser = argparse.ArgumentParser(description="Makes the NNUE network from games of the engine against itself")
+    commands = parser.add_subparsers(dest="command", required=True)
+    selfPlayParser = commands.add_parser("selfplay", help="play games and keep their positions with the search scores")
+    selfPlayParser.add_argument("--games", type=int, default=100)
+    selfPlayParser.add_argument("--depth", type=int, default=2, help="search depth of the moves and of the scores")
+    selfPlayParser.add_argument("--random-plies", type=int, default=8, help="random moves at the start of every game")
+    selfPlayParser.add_argument("--workers", type=int, default=os.cpu_count())
+    selfPlayParser.add_argument("--seed", type=int, default=1)
+    selfPlayParser.add_argument("--output", default="selfplay.npz")
+    trainParser = commands.add_parser("train", help="train a network on self-play files")
+    trainParser.add_argument("data", nargs="+", help="files written by selfplay")
+    trainParser.add_argument("--output", default="nnue.npz")
+    trainParser.add_argument("--hidden", type=int, default=HIDDEN, help="size of the accumulator")
+    trainParser.add_argument("--epochs", type=int, default=20)
+    trainParser.add_argument("--batch-size", type=int, default=1024)
+    trainParser.add_argument("--learning-rate", type=float, default=0.001)
+    trainParser.add_argument("--result-weight", type=float, default=0.3, help="share of the game result in the target")
+    trainParser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    if args.command == "selfplay":
+        selfPlay(args.games, args.depth, args.random_plies, args.workers, args.output, args.seed)
+    else:
+        train(args.data, args.output, args.hidden, args.epochs, args.batch_size, args.learning_rate, args.result_weight, args.seed)
+
+if __name__ == "__main__":
+    main()
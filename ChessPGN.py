@@ -0,0 +1,239 @@
+"""
+This file is responsible for reading games in PGN format and for converting moves to and from standard algebraic
+notation (SAN). Games are read one at a time from an open file, so archives of any size can be processed.
+It can also be run to analyse every game of a PGN file with the engine, using several worker processes:
+
+python ChessPGN.py games.pgn --output analysis.jsonl --depth 2 --workers 4
+"""
+
+import argparse
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import ChessEngine
+import ChessAI
+
+RESULTS = ("1-0", "0-1", "1/2-1/2", "*")
+headerPattern = re.compile(r'^\[(\w+)\s+"(.*)"\]\s*$')
+sanPattern = re.compile(r"^([NBRQK])?([a-h])?([1-8])?x?([a-h][1-8])(?:=?([NBRQ]))?$")
+specialPattern = re.compile(r"[{};()]") #the characters that open or close comments and variations
+
+'''
+Reads a PGN file lazily and yields one game at a time as a dict with the "headers" (a dict), the list of "moves"
+in SAN, and the "result". Comments, variations and numeric annotations are skipped.
+Only the current game is ever held in memory.
+'''
+def readGames(f):
+    headers = {}
+    movetext = []
+    inBrace = False #inside a {comment} that goes on past the end of the line
+    variationDepth = 0 #(variations) still open
+    for line in f:
+        line = line.strip()
+        if line.startswith("%"): #escaped line
+            continue
+        match = headerPattern.match(line)
+        if match:
+            if movetext: #a header right after movetext means the previous game had no result token
+                yield parseMovetext(headers, "\n".join(movetext))
+                headers = {}
+                movetext = []
+            inBrace = False
+            variationDepth = 0
+            headers[match.group(1)] = match.group(2).replace('\\"', '"')
+        elif line != "":
+            movetext.append(line)
+            code = line
+            for special in specialPattern.finditer(line): #a result inside a comment or a variation does not end the game
+                char = special.group()
+                if inBrace:
+                    inBrace = char != "}"
+                elif char == "{":
+                    inBrace = True
+                elif char == ";": #the rest of the line is a comment
+                    code = line[:special.start()]
+                    break
+                elif char == "(":
+                    variationDepth += 1
+                elif variationDepth > 0:
+                    variationDepth -= 1
+            if not inBrace and variationDepth == 0 and code.split() and code.split()[-1] in RESULTS:
+                yield parseMovetext(headers, "\n".join(movetext))
+                headers = {}
+                movetext = []
+    if headers or movetext:
+        yield parseMovetext(headers, "\n".join(movetext))
+
+'''
+Splits the movetext of one game into its SAN moves and result
+'''
+def parseMovetext(headers, text):
+    text = re.sub(r"\{[^}]*\}", " ", text) #comments
+    text = re.sub(r";[^\n]*", " ", text) #rest of line comments
+    while "(" in text: #variations, innermost first
+        stripped = re.sub(r"\([^()]*\)", " ", text)
+        if stripped == text:
+            break
+        text = stripped
+    moves = []
+    result = headers.get("Result", "*")
+    for token in text.split():
+        token = re.sub(r"^\d+\.+", "", token) #move numbers, possibly glued to the move
+        if token == "" or token.startswith("$"):
+            continue
+        if token in RESULTS:
+            result = token
+        else:
+            moves.append(token)
+    return {"headers": headers, "moves": moves, "result": result}
+
+'''
+Returns a GameState set up at the start position of the game (the FEN tag is used if there is one)
+'''
+def startPosition(game):
+    gs = ChessEngine.GameState()
+    if "FEN" in game["headers"]:
+        gs.loadFEN(game["headers"]["FEN"])
+    return gs
+
+'''
+Finds the move written in SAN among the valid moves. Raises a ValueError if it is illegal or ambiguous
+'''
+def sanToMove(san, validMoves):
+    san = san.rstrip("+#!?")
+    if san in ("O-O", "0-0", "O-O-O", "0-0-0"):
+        endCol = 6 if len(san) == 3 else 2
+        for move in validMoves:
+            if move.isCastleMove and move.endCol == endCol:
+                return move
+        raise ValueError("illegal move: " + san)
+
+    match = sanPattern.match(san)
+    if not match:
+        raise ValueError("not a SAN move: " + san)
+    piece, fromFile, fromRank, endSquare, promotion = match.groups()
+    if promotion is not None and promotion != 'Q':
+        raise ValueError("only promotion to a queen is supported: " + san)
+    piece = piece if piece is not None else 'p'
+    endRow = ChessEngine.Move.ranksToRows[endSquare[1]]
+    endCol = ChessEngine.Move.filesToCols[endSquare[0]]
+    candidates = []
+    for move in validMoves:
+        if move.pieceMoved[1] == piece and move.endRow == endRow and move.endCol == endCol and not move.isCastleMove:
+            if fromFile is not None and move.startCol != ChessEngine.Move.filesToCols[fromFile]:
+                continue
+            if fromRank is not None and move.startRow != ChessEngine.Move.ranksToRows[fromRank]:
+                continue
+            candidates.append(move)
+    if len(candidates) != 1:
+        raise ValueError(("ambiguous move: " if candidates else "illegal move: ") + san)
+    return candidates[0]
+
+'''
+Writes the move in SAN, with the file or rank of the piece when another piece of the same kind could go to
+the same square, and "+" or "#" when the move gives check or mate
+'''
+def moveToSAN(gs, move, validMoves):
+    if move.isCastleMove:
+        san = "O-O" if move.endCol == 6 else "O-O-O"
+    else:
+        endSquare = move.getRankFile(move.endRow, move.endCol)
+        if move.pieceMoved[1] == 'p':
+            san = (move.colsToFiles[move.startCol] + "x" if move.isCapture else "") + endSquare
+            if move.isPawnPromotion:
+                san += "=Q"
+        else:
+            san = move.pieceMoved[1]
+            others = [other for other in validMoves if other.pieceMoved == move.pieceMoved and other.endRow == move.endRow
+                      and other.endCol == move.endCol and other != move]
+            if others:
+                if all(other.startCol != move.startCol for other in others):
+                    san += move.colsToFiles[move.startCol]
+                elif all(other.startRow != move.startRow for other in others):
+                    san += move.rowsToRanks[move.startRow]
+                else:
+                    san += move.getRankFile(move.startRow, move.startCol)
+            san += ("x" if move.isCapture else "") + endSquare
+
+    gs.makeMove(move)
+    replies = gs.getValidMoves()
+    if gs.inCheck:
+        san += "#" if len(replies) == 0 else "+"
+    gs.undoMove()
+    return san
+
+'''
+Analyses one game in a worker process. For every move it records the evaluation of the position before the move
+(in pawns, positive is good for white), the engine's best move and the move played. task is (game index, game, depth)
+'''
+def analyzeGame(task):
+    index, game, depth = task
+    record = {"index": index, "headers": game["headers"], "result": game["result"], "moves": []}
+    try:
+        gs = startPosition(game)
+    except (ValueError, IndexError, KeyError) as e:
+        record["error"] = "bad FEN: " + str(e)
+        return record
+
+    for ply in range(len(game["moves"]) + 1):
+        validMoves = gs.getValidMoves()
+        turnMultiplier = 1 if gs.whiteToMove else -1
+        if len(validMoves) == 0:
+            score = -ChessAI.CHECKMATE if gs.checkmate else ChessAI.STALEMATE
+            bestMove = None
+        else:
+            bestMove, score, nodes = ChessAI.searchPosition(gs, validMoves, depth)
+        if record["moves"]: #the score of this position is the score of the move that led to it
+            record["moves"][-1]["playedEval"] = round(turnMultiplier * score, 2)
+        if ply == len(game["moves"]):
+            break
+
+        san = game["moves"][ply]
+        entry = {"ply": ply + 1, "fen": gs.getFEN(), "played": san, "eval": round(turnMultiplier * score, 2),
+                 "best": moveToSAN(gs, bestMove, validMoves) if bestMove is not None else None}
+        record["moves"].append(entry)
+        try:
+            gs.makeMove(sanToMove(san, validMoves))
+        except ValueError as e:
+            record["error"] = "move %d: %s" % (ply + 1, e)
+            break
+    return record
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyses every game of a PGN file with the engine")
+    parser.add_argument("pgn", help="PGN file to read")
+    parser.add_argument("--output", default="-", help="JSON lines file to write the analysis to (default: stdout)")
+    parser.add_argument("--depth", type=int, default=2, help="search depth for every position")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+    args = parser.parse_args()
+
+    output = open(args.output, "w") if args.output != "-" else None
+    maxPending = args.workers * 2 #only a few games are read ahead of the workers, so memory use stays flat
+    with open(args.pgn, errors="replace") as pgnFile, ProcessPoolExecutor(max_workers=args.workers) as pool:
+        games = enumerate(readGames(pgnFile), 1)
+        pending = set()
+        finished = False
+        while not finished or pending:
+            while not finished and len(pending) < maxPending:
+                try:
+                    index, game = next(games)
+                except StopIteration:
+                    finished = True
+                    break
+                pending.add(pool.submit(analyzeGame, (index, game, args.depth)))
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                line = json.dumps(future.result())
+                if output is not None:
+                    output.write(line + "\n")
+                    output.flush()
+                else:
+                    print(line, flush=True)
+    if output is not None:
+        output.close()
+
+if __name__ == "__main__":
+    main()
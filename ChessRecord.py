@@ -0,0 +1,147 @@
+"""
+This file is responsible for storing finished or archived games compactly. A GameRecord keeps the starting
+position, the headers, the result, and the moves as 16 bit numbers in an array (2 bytes per move instead of a
+Move object, a CastleRights object and a few log entries). The Move objects and the GameState are only rebuilt
+when they are needed, by replaying the moves.
+A record can be written to and read from a small binary format, so games can be stored or sent cheaply.
+"""
+
+import struct
+import sys
+from array import array
+import ChessEngine
+
+RESULTS = ("*", "1-0", "0-1", "1/2-1/2")
+MAGIC = b"CREC"
+VERSION = 1
+headerFormat = struct.Struct("<4sBBIHH") #magic, version, result, number of moves, FEN length, number of headers
+lengthFormat = struct.Struct("<H")
+
+#a move is packed as: bits 0-5 the start square, bits 6-11 the end square (row * 8 + col), then the flags
+ENPASSANT_FLAG = 1 << 12
+CASTLE_FLAG = 1 << 13
+PROMOTION_FLAG = 1 << 14 #the engine only promotes to a queen
+
+'''
+Packs a move into a number that fits in 16 bits
+'''
+def packMove(move):
+    packed = (move.startRow * 8 + move.startCol) | (move.endRow * 8 + move.endCol) << 6
+    if move.isEnpassantMove:
+        packed |= ENPASSANT_FLAG
+    if move.isCastleMove:
+        packed |= CASTLE_FLAG
+    if move.isPawnPromotion:
+        packed |= PROMOTION_FLAG
+    return packed
+
+'''
+Builds the Move object back from a packed move. board must be the position the move is played from
+'''
+def unpackMove(packed, board):
+    start = packed & 63
+    end = packed >> 6 & 63
+    return ChessEngine.Move((start // 8, start % 8), (end // 8, end % 8), board,
+                            isEnpassantMove=bool(packed & ENPASSANT_FLAG), castle=bool(packed & CASTLE_FLAG))
+
+'''
+The notation of a packed move, e.g. "e2e4", without replaying the game
+'''
+def packedNotation(packed):
+    start = packed & 63
+    end = packed >> 6 & 63
+    return ChessEngine.Move.colsToFiles[start % 8] + ChessEngine.Move.rowsToRanks[start // 8] + \
+           ChessEngine.Move.colsToFiles[end % 8] + ChessEngine.Move.rowsToRanks[end // 8]
+
+class GameRecord():
+    __slots__ = ("startFEN", "headers", "result", "moves")
+
+    def __init__(self, startFEN=None, headers=None, result="*"):
+        self.startFEN = startFEN #None for the usual starting position
+        self.headers = headers if headers is not None else {}
+        self.result = result
+        self.moves = array('H')
+
+    def __len__(self):
+        return len(self.moves)
+
+    def append(self, move):
+        self.moves.append(packMove(move))
+
+    '''
+    Returns a new GameState with every move of the record played, its move log holds the rebuilt Move objects.
+    upTo stops after that many moves
+    '''
+    def toGameState(self, upTo=None):
+        gs = ChessEngine.GameState()
+        if self.startFEN is not None:
+            gs.loadFEN(self.startFEN)
+        for packed in self.moves[:upTo]:
+            gs.makeMove(unpackMove(packed, gs.board))
+        return gs
+
+    '''
+    The Move objects of the game, in order
+    '''
+    def getMoves(self):
+        return self.toGameState().moveLog
+
+    def getNotations(self):
+        return [packedNotation(packed) for packed in self.moves]
+
+    '''
+    Writes the record in its binary format: a fixed size header, the starting FEN, the headers as pairs of
+    strings, then the packed moves. Strings are UTF-8 with a 2 byte length and numbers are little endian
+    '''
+    def toBytes(self):
+        fen = self.startFEN.encode() if self.startFEN is not None else b""
+        parts = [headerFormat.pack(MAGIC, VERSION, RESULTS.index(self.result), len(self.moves), len(fen), len(self.headers)), fen]
+        for name, value in self.headers.items():
+            for text in (name.encode(), str(value).encode()):
+                parts.append(lengthFormat.pack(len(text)))
+                parts.append(text)
+        moves = self.moves
+        if sys.byteorder == "big":
+            moves = array('H', moves)
+            moves.byteswap()
+        parts.append(moves.tobytes())
+        return b"".join(parts)
+
+'''
+Reads a record written by GameRecord.toBytes. Raises a ValueError if the data is not a game record
+'''
+def fromBytes(data):
+    if len(data) < headerFormat.size:
+        raise ValueError("not a game record")
+    magic, version, result, moveCount, fenLength, headerCount = headerFormat.unpack_from(data)
+    if magic != MAGIC or version != VERSION or result >= len(RESULTS):
+        raise ValueError("not a game record")
+    position = headerFormat.size
+    fen = bytes(data[position:position + fenLength]).decode()
+    position += fenLength
+    record = GameRecord(fen if fen != "" else None, {}, RESULTS[result])
+    try:
+        for i in range(headerCount):
+            texts = []
+            for j in range(2):
+                length = lengthFormat.unpack_from(data, position)[0]
+                position += lengthFormat.size
+                texts.append(bytes(data[position:position + length]).decode())
+                position += length
+            record.headers[texts[0]] = texts[1]
+    except struct.error:
+        raise ValueError("game record is cut short")
+    if len(data) - position != moveCount * 2:
+        raise ValueError("game record has the wrong length")
+    record.moves.frombytes(data[position:])
+    if sys.byteorder == "big":
+        record.moves.byteswap()
+    return record
+
+'''
+Makes a record of the game played so far in the GameState
+'''
+def recordGame(gs, headers=None, result="*"):
+    record = GameRecord(gs.startFEN, headers, result)
+    record.moves = array('H', [packMove(move) for move in gs.moveLog])
+    return record
@@ -0,0 +1,350 @@
+"""
+This is the game server. It keeps many games in memory and talks to clients over TCP, one JSON object per line.
+Engine moves are computed by a shared, bounded pool of worker processes. Every game has at most one request
+in the pool at a time and games take turns, so one busy game can't starve the others.
+
+Run it with: python ChessServer.py --port 8765 --workers 4 (add --cache analysis.db to keep the engine's results)
+
+Requests (every one gets exactly one JSON line back, with "ok" set to true or false):
+{"cmd": "new", "white": "human", "black": "bot", "depth": 3, "fen": "..."}  start a game ("fen" is optional, "depth"
+    goes from 1 to the --max-depth of the server)
+{"cmd": "move", "game": 1, "move": "e2e4"}  play a move, the answer comes once the bot has replied
+{"cmd": "bot", "game": 1}  let the engine play one move for the side to move (used for bot vs bot games)
+{"cmd": "state", "game": 1}  also works for the last MAX_ARCHIVED closed games, which are kept as compact records
+{"cmd": "close", "game": 1}
+{"cmd": "metrics"}  pool size, queue depth and latency percentiles
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import ChessEngine
+import ChessAI
+import ChessRecord
+
+MAX_SAMPLES = 1000 #latency samples kept for the metrics
+MAX_DEPTH = 6 #default for --max-depth
+MAX_ARCHIVED = 10000 #closed games kept for "state", the least recently used one is dropped first
+COMMANDS = ("new", "move", "bot", "state", "close", "metrics")
+
+'''
+Runs in a worker process: searches the position (written by GameState.toBytes) and returns the move as its
+moveID with the score and nodes
+'''
+def computeMove(position, depth):
+    gs = ChessEngine.GameState()
+    gs.loadBytes(position)
+    validMoves = gs.getValidMoves()
+    move, score, nodes = ChessAI.searchCached(gs, validMoves, depth)
+    if move is None: #every move gets mated, play one anyway
+        move = validMoves[0]
+    return move.moveID, score, nodes
+
+'''
+Runs once in every worker process when it starts, the workers don't inherit the settings of the server process
+everywhere (processes are spawned rather than forked on some systems)
+'''
+def initWorker(cacheFile):
+    ChessAI.CACHE_FILE = cacheFile
+
+'''
+Median, 95th percentile and maximum of the latency samples (in seconds), in milliseconds
+'''
+def percentiles(samples):
+    if not samples:
+        return {"p50": 0, "p95": 0, "max": 0}
+    ordered = sorted(samples)
+    return {"p50": round(ordered[len(ordered) // 2] * 1000, 1),
+            "p95": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 1),
+            "max": round(ordered[-1] * 1000, 1)}
+
+'''
+A game hosted by the server. It holds a GameRecord of the moves and the current position as GameState.toBytes(),
+a few hundred bytes however long the game is, and rebuilds the GameState when a request needs it
+'''
+class ServerGame():
+
+    def __init__(self, gameId, white, black, depth, fen=None):
+        self.gameId = gameId
+        gs = ChessEngine.GameState()
+        if fen is not None:
+            gs.loadFEN(fen)
+        self.players = {'w': white, 'b': black}
+        self.depth = depth
+        self.record = ChessRecord.GameRecord(gs.startFEN, {"White": white, "Black": black, "Depth": str(depth)})
+        self.update(gs)
+
+    '''
+    Keeps the position of gs as the current one
+    '''
+    def update(self, gs):
+        gs.getValidMoves() #sets checkmate and stalemate
+        self.position = gs.toBytes()
+        self.whiteToMove = gs.whiteToMove
+        if gs.checkmate:
+            self.record.result = "0-1" if gs.whiteToMove else "1-0"
+        elif gs.stalemate:
+            self.record.result = "1/2-1/2"
+
+    '''
+    A GameState of the current position, with an empty move log
+    '''
+    def getGameState(self):
+        gs = ChessEngine.GameState()
+        gs.loadBytes(self.position)
+        return gs
+
+    def getValidMoves(self):
+        return self.getGameState().getValidMoves()
+
+    def isOver(self):
+        return self.record.result != "*"
+
+    def botToMove(self):
+        return not self.isOver() and self.players['w' if self.whiteToMove else 'b'] == "bot"
+
+    '''
+    Plays the move, which must be one of getValidMoves()
+    '''
+    def makeMove(self, move):
+        gs = self.getGameState()
+        gs.makeMove(move)
+        self.record.append(move)
+        self.update(gs)
+
+    def getResult(self):
+        return self.record.result
+
+    def getState(self):
+        state = {"game": self.gameId, "fen": self.getGameState().getFEN(), "moves": self.record.getNotations(),
+                 "toMove": 'w' if self.whiteToMove else 'b'}
+        if self.getResult() != "*":
+            state["result"] = self.getResult()
+        return state
+
+'''
+Sends engine requests to the process pool. Requests wait in a queue per game and the games with waiting requests
+are served in turn, one request per game in the pool at a time
+'''
+class EngineDispatcher():
+
+    def __init__(self, workers, cacheFile=None):
+        self.workers = workers
+        self.cacheFile = cacheFile
+        self.pool = self.newPool()
+        self.gameQueues = {} #game id -> deque of (position, depth, future, time queued)
+        self.readyGames = deque() #games with waiting requests and nothing in the pool, in the order they get served
+        self.running = 0
+        self.queueWaits = deque(maxlen=MAX_SAMPLES)
+        self.serviceTimes = deque(maxlen=MAX_SAMPLES)
+
+    '''
+    Queues a search for the game and returns (moveID, score, nodes) once a worker has done it
+    '''
+    async def requestMove(self, gameId, position, depth):
+        future = asyncio.get_running_loop().create_future()
+        queue = self.gameQueues.setdefault(gameId, deque())
+        queue.append((position, depth, future, time.perf_counter()))
+        if len(queue) == 1 and gameId not in self.readyGames:
+            self.readyGames.append(gameId)
+        self.dispatch()
+        return await future
+
+    def newPool(self):
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=initWorker, initargs=(self.cacheFile,))
+
+    '''
+    Replaces the pool once a worker process has died, a broken ProcessPoolExecutor fails every later request.
+    Only the pool that broke is replaced, the requests that were running in it all report it
+    '''
+    def restartPool(self, brokenPool):
+        if brokenPool is self.pool:
+            self.pool.shutdown(wait=False)
+            self.pool = self.newPool()
+
+    '''
+    Fills the free workers, taking one request from each waiting game in turn
+    '''
+    def dispatch(self):
+        while self.running < self.workers and self.readyGames:
+            gameId = self.readyGames.popleft()
+            position, depth, future, queuedAt = self.gameQueues[gameId][0]
+            self.running += 1
+            startedAt = time.perf_counter()
+            self.queueWaits.append(startedAt - queuedAt)
+            pool = self.pool
+            try:
+                work = asyncio.get_running_loop().run_in_executor(pool, computeMove, position, depth)
+            except BrokenProcessPool: #a worker died and the requests running then haven't reported it yet
+                self.restartPool(pool)
+                pool = self.pool
+                work = asyncio.get_running_loop().run_in_executor(pool, computeMove, position, depth)
+            work.add_done_callback(lambda done, gameId=gameId, future=future, startedAt=startedAt, pool=pool:
+                                   self.finished(gameId, future, startedAt, done, pool))
+
+    def finished(self, gameId, future, startedAt, done, pool):
+        self.running -= 1
+        self.serviceTimes.append(time.perf_counter() - startedAt)
+        queue = self.gameQueues[gameId]
+        queue.popleft()
+        if queue:
+            self.readyGames.append(gameId) #back of the line, behind the games that were waiting
+        else:
+            del self.gameQueues[gameId]
+        if done.cancelled(): #the pool was shut down
+            future.cancel()
+        else:
+            if isinstance(done.exception(), BrokenProcessPool):
+                self.restartPool(pool)
+            if not future.cancelled():
+                if done.exception() is not None:
+                    future.set_exception(done.exception())
+                else:
+                    future.set_result(done.result())
+        self.dispatch()
+
+    '''
+    Queue depth and latency percentiles of the recent requests
+    '''
+    def getMetrics(self):
+        return {"workers": self.workers, "running": self.running,
+                "queued": sum(len(queue) for queue in self.gameQueues.values()) - self.running,
+                "gamesWaiting": len(self.readyGames), "queueWaitMs": percentiles(self.queueWaits),
+                "searchMs": percentiles(self.serviceTimes)}
+
+'''
+Holds the games and answers the requests of the clients
+'''
+class GameServer():
+
+    def __init__(self, workers, defaultDepth, cacheFile=None, maxDepth=MAX_DEPTH):
+        self.games = {}
+        self.archive = OrderedDict() #game id -> GameRecord of the closed games, least recently used first
+        self.nextGameId = 1
+        self.defaultDepth = defaultDepth
+        self.maxDepth = maxDepth #a deeper search would hold a worker for minutes and starve the other games
+        self.dispatcher = EngineDispatcher(workers, cacheFile)
+        self.requestTimes = deque(maxlen=MAX_SAMPLES)
+
+    '''
+    Lets the engine play one move for the side to move
+    '''
+    async def playBotMove(self, game):
+        if game.isOver():
+            return
+        plies = len(game.record)
+        moveID, score, nodes = await self.dispatcher.requestMove(game.gameId, game.position, game.depth)
+        if self.games.get(game.gameId) is not game or len(game.record) != plies:
+            return #the game was closed or changed while the engine was thinking
+        for move in game.getValidMoves():
+            if move.moveID == moveID:
+                game.makeMove(move)
+                break
+
+    async def handle(self, request):
+        command = request.get("cmd")
+        if command not in COMMANDS:
+            return {"ok": False, "error": "unknown command"}
+        if command == "metrics":
+            metrics = self.dispatcher.getMetrics()
+            metrics["games"] = len(self.games)
+            metrics["closedGames"] = len(self.archive)
+            metrics["requestMs"] = percentiles(self.requestTimes)
+            return {"ok": True, "metrics": metrics}
+
+        if command == "new":
+            depth = int(request.get("depth", self.defaultDepth))
+            if depth < 1 or depth > self.maxDepth:
+                return {"ok": False, "error": "depth must be between 1 and %d" % self.maxDepth}
+            game = ServerGame(self.nextGameId, request.get("white", "human"), request.get("black", "bot"),
+                              depth, request.get("fen"))
+            self.games[game.gameId] = game
+            self.nextGameId += 1
+            if game.botToMove():
+                await self.playBotMove(game)
+            return dict(ok=True, **game.getState())
+
+        game = self.games.get(request.get("game"))
+        if game is None:
+            record = self.archive.get(request.get("game"))
+            if command == "state" and record is not None:
+                self.archive.move_to_end(request.get("game"))
+                gs = record.toGameState()
+                return {"ok": True, "game": request.get("game"), "fen": gs.getFEN(), "moves": record.getNotations(),
+                        "toMove": 'w' if gs.whiteToMove else 'b', "result": record.result, "closed": True}
+            return {"ok": False, "error": "unknown game"}
+        if command == "state":
+            return dict(ok=True, **game.getState())
+        if command == "close":
+            self.archive[game.gameId] = game.record
+            if len(self.archive) > MAX_ARCHIVED:
+                self.archive.popitem(last=False)
+            del self.games[game.gameId]
+            return {"ok": True}
+        if command == "bot":
+            await self.playBotMove(game)
+            return dict(ok=True, **game.getState())
+        if command == "move":
+            if game.botToMove():
+                return {"ok": False, "error": "it is the bot's turn"}
+            for move in game.getValidMoves():
+                if move.getChessNotation() == request.get("move", "")[:4]:
+                    game.makeMove(move)
+                    if game.botToMove():
+                        await self.playBotMove(game)
+                    return dict(ok=True, **game.getState())
+            return {"ok": False, "error": "illegal move"}
+
+    '''
+    Serves one client connection. Requests of a connection are answered in order, different connections
+    (and so different games) are served concurrently
+    '''
+    async def serveClient(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                startTime = time.perf_counter()
+                try:
+                    request = json.loads(line)
+                    if isinstance(request, dict):
+                        response = await self.handle(request)
+                    else:
+                        response = {"ok": False, "error": "a request must be a JSON object"}
+                except Exception as e: #a bad request, but also a search that failed in the pool or an error of the cache
+                    response = {"ok": False, "error": "%s: %s" % (type(e).__name__, e)}
+                self.requestTimes.append(time.perf_counter() - startTime)
+                writer.write((json.dumps(response) + "\n").encode())
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+async def runServer(host, port, workers, depth, cacheFile=None, maxDepth=MAX_DEPTH):
+    server = GameServer(workers, depth, cacheFile, maxDepth)
+    tcpServer = await asyncio.start_server(server.serveClient, host, port)
+    print("Serving games on %s:%d with %d engine workers" % (host, port, workers), flush=True)
+    async with tcpServer:
+        await tcpServer.serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description="Hosts many games at once for human and bot players")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=2, help="size of the engine process pool")
+    parser.add_argument("--depth", type=int, default=ChessAI.DEPTH, help="default search depth of the bots")
+    parser.add_argument("--max-depth", type=int, default=MAX_DEPTH, help="deepest search a client may ask for")
+    parser.add_argument("--cache", help="SQLite file of the analysis cache the workers share, e.g. analysis.db")
+    args = parser.parse_args()
+    if not 1 <= args.depth <= args.max_depth:
+        parser.error("--depth must be between 1 and --max-depth")
+    asyncio.run(runServer(args.host, args.port, args.workers, args.depth, args.cache, args.max_depth))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+"""
+This is the headless tournament runner. It plays engine vs engine games in a pool of worker processes, without
+pygame, and reports the results with an Elo difference and an SPRT test. It is used to check that a change to
+ChessEngine or ChessAI does not cost playing strength.
+
+Example: python ChessTournament.py --games 100 --engine1 depth=3 --engine2 depth=3,QUIESCENCE_DEPTH=1
+"""
+
+import argparse
+import json
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import ChessEngine
+import ChessAI
+
+#a few balanced positions after common openings, every one is played twice so each engine gets both colors
+DEFAULT_OPENINGS = [
+    "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1",
+    "rnbqkbnr/pppp1ppp/8/4p3/4P3/8/PPPP1PPP/RNBQKBNR w KQkq - 0 2", #open game
+    "rnbqkbnr/pp1ppppp/8/2p5/4P3/8/PPPP1PPP/RNBQKBNR w KQkq - 0 2", #sicilian
+    "rnbqkbnr/pppp1ppp/4p3/8/4P3/8/PPPP1PPP/RNBQKBNR w KQkq - 0 2", #french
+    "rnbqkbnr/ppp1pppp/8/3p4/3P4/8/PPP1PPPP/RNBQKBNR w KQkq - 0 2", #queen's pawn
+    "rnbqkb1r/pppppppp/5n2/8/2P5/8/PP1PPPPP/RNBQKBNR w KQkq - 1 2", #english
+    "r1bqkbnr/pppp1ppp/2n5/1B2p3/4P3/5N2/PPPP1PPP/RNBQK2R b KQkq - 3 3", #ruy lopez
+    "rnbqkb1r/pppppp1p/5np1/8/2PP4/8/PP2PPPP/RNBQKBNR w KQkq - 0 3", #king's indian
+]
+
+MAX_PLIES = 300 #games still going after this many plies are adjudicated as draws
+SPRT_PRIOR = 0.5 #games of each result assumed before the first one is played
+AI_CONSTANTS = {name: value for name, value in vars(ChessAI).items() if name.isupper()} #untouched values to reset to
+
+'''
+Parses an engine description like "depth=3,time=0.5,QUIESCENCE_DEPTH=1". depth and time are the search limits
+for every move (time in seconds), names in capitals override the constant with that name in ChessAI
+'''
+def parseEngine(description):
+    engine = {"depth": ChessAI.DEPTH, "time": None, "constants": {}}
+    for option in description.split(","):
+        if option.strip() == "":
+            continue
+        name, value = option.split("=")
+        name = name.strip()
+        if name == "depth":
+            engine["depth"] = int(value)
+        elif name == "time":
+            engine["time"] = float(value)
+        elif name.isupper() and hasattr(ChessAI, name):
+            engine["constants"][name] = parseConstant(AI_CONSTANTS[name], value.strip())
+        else:
+            raise ValueError("unknown engine option: " + name)
+    return engine
+
+'''
+Converts the text of an engine option to the type of the ChessAI constant it overrides. bool("False") is True,
+so booleans are read by hand, and constants that default to None (like CACHE_FILE) take a string or "None"
+'''
+def parseConstant(default, value):
+    if isinstance(default, bool):
+        if value.lower() in ("true", "1"):
+            return True
+        if value.lower() in ("false", "0"):
+            return False
+        raise ValueError("not a boolean: " + value)
+    if default is None:
+        return None if value == "None" else value
+    return type(default)(value)
+
+'''
+Reads one FEN per line, the lines of an EPD file work too since only the first four fields are needed
+'''
+def loadOpenings(path):
+    openings = []
+    with open(path) as f:
+        for line in f:
+            line = line.split("#")[0].strip()
+            if line != "":
+                fields = line.split()
+                openings.append(" ".join(fields[:6]) if len(fields) >= 6 and fields[4].isdigit() else " ".join(fields[:4]) + " 0 1")
+    return openings
+
+'''
+Only kings, or a king and a single minor piece against a bare king, can't mate
+'''
+def insufficientMaterial(board):
+    pieces = [square[1] for row in board for square in row if square != "--" and square[1] != 'K']
+    return len(pieces) == 0 or (len(pieces) == 1 and pieces[0] in ('B', 'N'))
+
+'''
+Plays one game from the opening and returns a dict with the result and the search statistics of both engines.
+task is (game number, opening FEN, white engine name, white engine, black engine name, black engine)
+'''
+def playGame(task):
+    gameNumber, opening, whiteName, whiteEngine, blackName, blackEngine = task
+    gs = ChessEngine.GameState()
+    gs.loadFEN(opening)
+    defaults = {name: AI_CONSTANTS[name] for engine in (whiteEngine, blackEngine) for name in engine["constants"]}
+    stats = {whiteName: {"nodes": 0, "time": 0.0, "moveTimes": []}, blackName: {"nodes": 0, "time": 0.0, "moveTimes": []}}
+    tables = {whiteName: {}, blackName: {}} #each engine keeps its own transposition table for the game
+    positionCounts = {}
+    moves = []
+    result = None
+    termination = None
+
+    while result is None:
+        validMoves = gs.getValidMoves()
+        if gs.checkmate:
+            result = "0-1" if gs.whiteToMove else "1-0"
+            termination = "checkmate"
+            break
+        if gs.stalemate:
+            result, termination = "1/2-1/2", "stalemate"
+            break
+        fen = gs.getFEN().split()
+        position = " ".join(fen[:4])
+        positionCounts[position] = positionCounts.get(position, 0) + 1
+        if positionCounts[position] >= 3:
+            result, termination = "1/2-1/2", "repetition"
+        elif int(fen[4]) >= 100:
+            result, termination = "1/2-1/2", "fifty moves"
+        elif insufficientMaterial(gs.board):
+            result, termination = "1/2-1/2", "insufficient material"
+        elif len(moves) >= MAX_PLIES:
+            result, termination = "1/2-1/2", "adjudication"
+        if result is not None:
+            break
+
+        name, engine = (whiteName, whiteEngine) if gs.whiteToMove else (blackName, blackEngine)
+        for constant, value in defaults.items():
+            setattr(ChessAI, constant, engine["constants"].get(constant, value))
+        ChessAI.transpositionTable = tables[name] #entries of the other engine or of earlier games would leak in
+        startTime = time.time()
+        move, score, nodes = ChessAI.searchPosition(gs, validMoves, engine["depth"], engine["time"])
+        elapsed = time.time() - startTime
+        if move is None: #every move loses, play anything
+            move = validMoves[0]
+        stats[name]["nodes"] += nodes
+        stats[name]["time"] += elapsed
+        stats[name]["moveTimes"].append(round(elapsed, 4))
+        moves.append(move.getChessNotation())
+        gs.makeMove(move)
+
+    ChessAI.transpositionTable = {}
+    return {"game": gameNumber, "opening": opening, "white": whiteName, "black": blackName, "result": result,
+            "termination": termination, "plies": len(moves), "moves": moves, "stats": stats}
+
+'''
+Elo difference for a score fraction, with the half width of its 95% confidence interval
+'''
+def eloDifference(wins, draws, losses):
+    games = wins + draws + losses
+    score = (wins + draws / 2) / games
+    if score <= 0 or score >= 1:
+        return (math.inf if score >= 1 else -math.inf), math.inf
+    variance = (wins * (1 - score) ** 2 + draws * (0.5 - score) ** 2 + losses * score ** 2) / games
+    margin = 1.96 * math.sqrt(variance / games)
+    toElo = lambda s: -400 * math.log10(1 / min(max(s, 1e-9), 1 - 1e-9) - 1)
+    return toElo(score), (toElo(score + margin) - toElo(score - margin)) / 2
+
+'''
+Log likelihood ratio of the SPRT for H1: elo = elo1 against H0: elo = elo0, using the normal approximation
+of the game scores. Every count gets SPRT_PRIOR games added so the variance is never 0 and a run of
+identical results still moves the test
+'''
+def sprtLLR(wins, draws, losses, elo0, elo1):
+    if wins + draws + losses == 0:
+        return 0.0
+    wins, draws, losses = wins + SPRT_PRIOR, draws + SPRT_PRIOR, losses + SPRT_PRIOR
+    games = wins + draws + losses
+    score = (wins + draws / 2) / games
+    variance = (wins * (1 - score) ** 2 + draws * (0.5 - score) ** 2 + losses * score ** 2) / games
+    score0 = 1 / (1 + 10 ** (-elo0 / 400))
+    score1 = 1 / (1 + 10 ** (-elo1 / 400))
+    return (score1 - score0) * (2 * score - score0 - score1) * games / (2 * variance)
+
+def main():
+    parser = argparse.ArgumentParser(description="Plays engine vs engine games and compares their strength")
+    parser.add_argument("--engine1", default="", help='e.g. "depth=3,time=1,QUIESCENCE_DEPTH=1"')
+    parser.add_argument("--engine2", default="", help="same format as --engine1")
+    parser.add_argument("--games", type=int, default=20, help="number of games, rounded up to a pair per opening")
+    parser.add_argument("--openings", help="file with one FEN (or EPD) per line")
+    parser.add_argument("--concurrency", type=int, default=os.cpu_count(), help="games played at the same time")
+    parser.add_argument("--sprt", nargs=2, type=float, metavar=("ELO0", "ELO1"), help="stop early once the SPRT decides")
+    parser.add_argument("--alpha", type=float, default=0.05)
+    parser.add_argument("--beta", type=float, default=0.05)
+    parser.add_argument("--output", help="write every finished game as a JSON line to this file")
+    args = parser.parse_args()
+    if args.games < 1:
+        parser.error("--games must be at least 1")
+
+    engines = {"engine1": parseEngine(args.engine1), "engine2": parseEngine(args.engine2)}
+    openings = loadOpenings(args.openings) if args.openings else DEFAULT_OPENINGS
+    tasks = []
+    for i in range((args.games + 1) // 2):
+        opening = openings[i % len(openings)]
+        tasks.append((len(tasks) + 1, opening, "engine1", engines["engine1"], "engine2", engines["engine2"]))
+        tasks.append((len(tasks) + 1, opening, "engine2", engines["engine2"], "engine1", engines["engine1"]))
+
+    lowerBound = math.log(args.beta / (1 - args.alpha))
+    upperBound = math.log((1 - args.beta) / args.alpha)
+    wins = draws = losses = 0 #from engine1's point of view
+    totals = {"engine1": {"nodes": 0, "time": 0.0, "moves": 0}, "engine2": {"nodes": 0, "time": 0.0, "moves": 0}}
+    output = open(args.output, "a") if args.output else None
+    verdict = None
+
+    #games are handed out as workers get free, so none start once the SPRT has decided. The games still
+    #running then are left to finish but their results are not counted
+    with ProcessPoolExecutor(max_workers=args.concurrency) as pool:
+        nextTask = 0
+        pending = set()
+        while verdict is None and (nextTask < len(tasks) or pending):
+            while nextTask < len(tasks) and len(pending) < args.concurrency:
+                pending.add(pool.submit(playGame, tasks[nextTask]))
+                nextTask += 1
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if verdict is not None: #the SPRT decided on a game that finished at the same time
+                    break
+                game = future.result()
+                if game["result"] == "1/2-1/2":
+                    draws += 1
+                elif (game["result"] == "1-0") == (game["white"] == "engine1"):
+                    wins += 1
+                else:
+                    losses += 1
+                for name, stats in game["stats"].items():
+                    totals[name]["nodes"] += stats["nodes"]
+                    totals[name]["time"] += stats["time"]
+                    totals[name]["moves"] += len(stats["moveTimes"])
+                if output is not None:
+                    output.write(json.dumps(game) + "\n")
+                    output.flush()
+
+                line = "Game %d: %s (%s) +%d =%d -%d" % (game["game"], game["result"], game["termination"], wins, draws, losses)
+                if args.sprt:
+                    llr = sprtLLR(wins, draws, losses, args.sprt[0], args.sprt[1])
+                    line += " LLR %.2f [%.2f, %.2f]" % (llr, lowerBound, upperBound)
+                    if llr >= upperBound:
+                        verdict = "H1 accepted: engine1 is at least %g Elo stronger" % args.sprt[1]
+                    elif llr <= lowerBound:
+                        verdict = "H0 accepted: engine1 is not %g Elo stronger" % args.sprt[1]
+                print(line, flush=True)
+
+    if output is not None:
+        output.close()
+    games = wins + draws + losses
+    elo, margin = eloDifference(wins, draws, losses)
+    print("\nGames: %d  engine1: +%d =%d -%d  score %.1f%%" % (games, wins, draws, losses, 100 * (wins + draws / 2) / games))
+    print("Elo difference: %.1f +/- %.1f" % (elo, margin))
+    for name, total in totals.items():
+        nps = total["nodes"] / total["time"] if total["time"] > 0 else 0
+        averageTime = total["time"] / total["moves"] if total["moves"] > 0 else 0
+        print("%s: %d nodes, %.0f nodes/sec, %.3f sec/move" % (name, total["nodes"], nps, averageTime))
+    if args.sprt:
+        print(verdict if verdict is not None else "SPRT inconclusive")
+
+if __name__ == "__main__":
+    main()
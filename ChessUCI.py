@@ -0,0 +1,179 @@
+"""
+This is the UCI (Universal Chess Interface) front end. It lets chess GUIs and test harnesses play against the
+engine without pygame: commands are read from stdin and answers are written to stdout.
+The search runs in a background thread, so "stop" and "isready" are answered while it is thinking.
+
+Run it with: python ChessUCI.py
+"""
+
+import sys
+import threading
+import ChessEngine
+import ChessAI
+
+ENGINE_NAME = "ChessAI"
+MAX_DEPTH = 64 #depth used when the search is only limited by time or by "stop"
+MAX_MULTIPV = 256 #more lines than there are legal moves in any position
+
+outputLock = threading.Lock()
+
+'''
+Writes one line for the GUI, the search thread and the input loop both write so the lines must not mix
+'''
+def send(line):
+    with outputLock:
+        sys.stdout.write(line + "\n")
+        sys.stdout.flush()
+
+'''
+Writes the move in UCI notation, e.g. "e2e4", or "e7e8q" for a promotion
+'''
+def moveToUCI(move):
+    return move.getChessNotation() + ("q" if move.isPawnPromotion else "")
+
+'''
+Handles "position [startpos | fen <fen>] [moves <move> ...]" and returns the new GameState
+'''
+def setPosition(tokens):
+    gs = ChessEngine.GameState()
+    movesIndex = tokens.index("moves") if "moves" in tokens else len(tokens)
+    if len(tokens) > 1 and tokens[1] == "fen":
+        gs.loadFEN(" ".join(tokens[2:movesIndex]))
+    for token in tokens[movesIndex + 1:]:
+        for move in gs.getValidMoves():
+            if moveToUCI(move) == token or move.getChessNotation() == token:
+                gs.makeMove(move)
+                break
+        else:
+            send("info string illegal move " + token)
+            break
+    return gs
+
+'''
+Turns the "go" parameters into a search depth and a time limit in seconds (None when there is no limit)
+'''
+def searchLimits(tokens, whiteToMove):
+    params = {}
+    for i in range(1, len(tokens) - 1):
+        if tokens[i] in ("depth", "movetime", "wtime", "btime", "winc", "binc", "movestogo"):
+            params[tokens[i]] = int(tokens[i + 1])
+    if "infinite" in tokens:
+        return MAX_DEPTH, None
+    depth = params.get("depth", MAX_DEPTH)
+    if "movetime" in params:
+        return depth, params["movetime"] / 1000
+    timeLeft = params.get("wtime" if whiteToMove else "btime")
+    if timeLeft is not None:
+        increment = params.get("winc" if whiteToMove else "binc", 0)
+        movesToGo = params.get("movestogo", 30)
+        #spend an even share of the clock plus most of the increment, and never more than half of what is left
+        return depth, min(timeLeft / movesToGo + increment * 0.8, timeLeft / 2) / 1000
+    if "depth" in params:
+        return depth, None
+    return ChessAI.DEPTH, None
+
+'''
+Sends the "info" line for one line of a finished iteration of the search
+'''
+def sendInfo(depth, score, nodes, seconds, pv, lineNumber):
+    if abs(score) >= ChessAI.CHECKMATE: #mate scores don't count the moves, the length of the line does
+        movesToMate = (len(pv) + 1) // 2
+        scoreText = "mate %d" % (movesToMate if score > 0 else -movesToMate)
+    elif ChessAI.bitbasePlies(score) is not None: #the line ends in a bitbase position, add its plies to mate
+        movesToMate = (len(pv) + ChessAI.bitbasePlies(score) + 1) // 2
+        scoreText = "mate %d" % (movesToMate if score > 0 else -movesToMate)
+    else:
+        scoreText = "cp %d" % round(score * 100)
+    send("info depth %d multipv %d score %s nodes %d nps %d time %d pv %s" % (depth, lineNumber, scoreText, nodes,
+         nodes / max(seconds, 0.001), seconds * 1000, " ".join(moveToUCI(move) for move in pv)))
+
+'''
+Runs in the search thread and always ends with the "bestmove" line the GUI is waiting for. If releaseEvent is
+given the line is held back until it is set, even if the search ends first: by "stop" after "go infinite", by
+"stop" or "ponderhit" after "go ponder"
+'''
+def search(gs, depth, timeLimit, stopEvent, multiPV, releaseEvent=None):
+    validMoves = gs.getValidMoves()
+    move = None
+    if len(validMoves) > 0:
+        move, score, nodes = ChessAI.searchPosition(gs, validMoves, depth, timeLimit, stopEvent, sendInfo, multiPV)
+        if move is None: #every move gets mated, play one anyway
+            move = validMoves[0]
+    if releaseEvent is not None:
+        releaseEvent.wait()
+    send("bestmove " + (moveToUCI(move) if move is not None else "0000"))
+
+def main():
+    gs = ChessEngine.GameState()
+    multiPV = 1
+    searchThread = None
+    stopEvent = threading.Event()
+    releaseEvent = None
+    ponderTimeLimit = None
+
+    for line in sys.stdin:
+        tokens = line.split()
+        if not tokens:
+            continue
+        command = tokens[0]
+
+        if command in ("stop", "quit", "position", "go", "ucinewgame", "setoption") and searchThread is not None:
+            stopEvent.set() #the search thread sends bestmove as soon as it notices
+            if releaseEvent is not None:
+                releaseEvent.set()
+            searchThread.join()
+            searchThread = None
+
+        if command == "uci":
+            send("id name " + ENGINE_NAME)
+            send("option name Hash type spin default %d min 0 max 4096" % ChessAI.HASH_SIZE)
+            send("option name Threads type spin default 1 min 1 max 1") #the search is single threaded
+            send("option name MultiPV type spin default 1 min 1 max %d" % MAX_MULTIPV)
+            send("uciok")
+        elif command == "isready":
+            send("readyok")
+        elif command == "setoption" and "name" in tokens and "value" in tokens:
+            name = " ".join(tokens[tokens.index("name") + 1:tokens.index("value")])
+            value = " ".join(tokens[tokens.index("value") + 1:])
+            if name.lower() == "hash":
+                ChessAI.HASH_SIZE = int(value)
+                ChessAI.transpositionTable.clear()
+            elif name.lower() == "multipv":
+                multiPV = min(max(int(value), 1), MAX_MULTIPV)
+            elif name.lower() != "threads":
+                send("info string unknown option " + name)
+        elif command == "ucinewgame":
+            ChessAI.transpositionTable.clear()
+            gs = ChessEngine.GameState()
+        elif command == "position":
+            gs = setPosition(tokens)
+        elif command == "ponderhit" and searchThread is not None:
+            #the move we pondered on was played: keep searching, now on the clock of the "go ponder" command
+            releaseEvent.set()
+            if ponderTimeLimit is not None:
+                timer = threading.Timer(ponderTimeLimit, stopEvent.set)
+                timer.daemon = True
+                timer.start()
+        elif command == "go":
+            depth, timeLimit = searchLimits(tokens, gs.whiteToMove)
+            stopEvent = threading.Event()
+            releaseEvent = None
+            if "infinite" in tokens:
+                releaseEvent = stopEvent
+            elif "ponder" in tokens: #no time limit until "ponderhit"
+                releaseEvent = threading.Event()
+                ponderTimeLimit, timeLimit = timeLimit, None
+            searchThread = threading.Thread(target=search, args=(gs, depth, timeLimit, stopEvent, multiPV, releaseEvent),
+                                            daemon=True)
+            searchThread.start()
+        elif command == "quit":
+            break
+
+    if searchThread is not None: #stdin was closed during a search, finish it so bestmove is still written
+        stopEvent.set()
+        if releaseEvent is not None:
+            releaseEvent.set()
+        searchThread.join()
+
+if __name__ == "__main__":
+    main()